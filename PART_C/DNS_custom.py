@@ -2,6 +2,8 @@ import socket
 import struct
 import random
 import time
+import queue
+import threading
 from datetime import datetime
 
 ROOT_SERVERS = [
@@ -14,6 +16,8 @@ ROOT_SERVERS = [
 CACHE = {}
 LOG_FILE = "dns_log.txt"
 MAX_RECURSION = 5
+MAX_CNAME_CHAIN = 8
+MAX_PASSES = 2
 
 def decode_name(data, offset):
     labels = []
@@ -119,6 +123,196 @@ def ret_parse_dns_response(data):
     return ancount, nscount, arcount,answers, authority, additional
 
 
+HEADER = struct.Struct("!6H")
+RR_FIXED = struct.Struct("!HHIH")
+ANSWER, AUTHORITY, ADDITIONAL = 0, 1, 2
+MAX_POINTERS = 64
+
+
+class DNSPacket:
+    # lazy, copy-free view of a wire response: sections are only walked when
+    # asked for, and names are only decoded when needed. every name decoded
+    # is remembered by offset, so a compression pointer to it costs a dict lookup
+    __slots__ = ("data", "tid", "flags", "counts", "starts", "names")
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.tid, self.flags, qdcount, ancount, nscount, arcount = HEADER.unpack_from(data, 0)
+        self.counts = (ancount, nscount, arcount)
+        self.starts = [None, None, None]
+        self.names = {}
+        offset = 12
+        for _ in range(qdcount):
+            offset = self.skip_name(offset) + 4
+        self.starts[ANSWER] = offset
+
+    def skip_name(self, offset):
+        data = self.data
+        while True:
+            length = data[offset]
+            if length == 0:
+                return offset + 1
+            if length & 0xC0 == 0xC0:
+                return offset + 2
+            offset += 1 + length
+
+    def name_at(self, offset):
+        name = self.names.get(offset)
+        if name is not None:
+            return name
+        data = self.data
+        length = data[offset]
+        if length & 0xC0 == 0xC0:
+            # bare pointer, usually to a name decoded already
+            name = self.names.get(((length & 0x3F) << 8) | data[offset + 1])
+            if name is not None:
+                self.names[offset] = name
+                return name
+        labels = []
+        # offsets we land on (start and pointer targets) and how many labels precede them
+        landed = [(offset, 0)]
+        suffix = None
+        hops = 0
+        while True:
+            cached = self.names.get(offset)
+            if cached is not None and hops:
+                suffix = cached
+                break
+            length = data[offset]
+            if length == 0:
+                break
+            if length & 0xC0 == 0xC0:
+                hops += 1
+                if hops > MAX_POINTERS:
+                    raise ValueError("compression pointer loop")
+                offset = ((length & 0x3F) << 8) | data[offset + 1]
+                landed.append((offset, len(labels)))
+                continue
+            labels.append(str(data[offset + 1:offset + 1 + length], "ascii", "replace"))
+            offset += 1 + length
+        if suffix:
+            labels.append(suffix)
+        for start, first_label in landed:
+            if start not in self.names:
+                self.names[start] = ".".join(labels[first_label:])
+        return self.names[landed[0][0]]
+
+    def section_start(self, section):
+        if self.starts[section] is None:
+            offset = self.section_start(section - 1)
+            for _ in range(self.counts[section - 1]):
+                offset = self.skip_name(offset) + 10
+                offset += RR_FIXED.unpack_from(self.data, offset - 10)[3]
+            self.starts[section] = offset
+        return self.starts[section]
+
+    def records(self, section):
+        # yields (name offset, type, ttl, rdata offset, rdlength); names stay undecoded
+        offset = self.section_start(section)
+        for _ in range(self.counts[section]):
+            name_offset = offset
+            offset = self.skip_name(offset)
+            rtype, _, ttl, rdlength = RR_FIXED.unpack_from(self.data, offset)
+            offset += 10
+            yield name_offset, rtype, ttl, offset, rdlength
+            offset += rdlength
+        if section < ADDITIONAL and self.starts[section + 1] is None:
+            self.starts[section + 1] = offset
+
+    def addresses(self, section):
+        # A records as (name, ip, 1, ttl), like ret_parse_dns_response
+        data = self.data
+        return [(self.name_at(name_offset), socket.inet_ntoa(data[rdata:rdata + 4]), 1, ttl)
+                for name_offset, rtype, ttl, rdata, rdlength in self.records(section)
+                if rtype == 1 and rdlength == 4]
+
+    def answers(self):
+        return self.addresses(ANSWER)
+
+    def additional(self):
+        return self.addresses(ADDITIONAL)
+
+    def authority(self):
+        # NS records as (zone, nameserver, 2, ttl)
+        return [(self.name_at(name_offset), self.name_at(rdata), 2, ttl)
+                for name_offset, rtype, ttl, rdata, _ in self.records(AUTHORITY) if rtype == 2]
+
+    def answer_records(self):
+        # A and CNAME answers as (owner, type, ttl, rdata): raw 4 bytes for A, target name for CNAME
+        data = self.data
+        records = []
+        for name_offset, rtype, ttl, rdata, rdlength in self.records(ANSWER):
+            if rtype == 1 and rdlength == 4:
+                records.append((self.name_at(name_offset), 1, ttl, bytes(data[rdata:rdata + 4])))
+            elif rtype == 5:
+                records.append((self.name_at(name_offset), 5, ttl, self.name_at(rdata)))
+        return records
+
+
+POINTER = struct.Struct("!H")
+REPLY = bytearray(4096)
+REPLY_VIEW = memoryview(REPLY)
+MAX_UDP_REPLY = 512
+
+
+def write_name(name, offset, names):
+    # write name at offset, ending in a pointer to the longest suffix already in the reply
+    labels = name.split(".") if name else []
+    for i in range(len(labels)):
+        suffix = ".".join(labels[i:]).lower()
+        pointer = names.get(suffix)
+        if pointer is not None:
+            POINTER.pack_into(REPLY, offset, 0xC000 | pointer)
+            return offset + 2
+        if offset < 0x4000:
+            names[suffix] = offset
+        label = labels[i].encode()
+        REPLY[offset] = len(label)
+        REPLY[offset + 1:offset + 1 + len(label)] = label
+        offset += 1 + len(label)
+    REPLY[offset] = 0
+    return offset + 1
+
+
+def build_response(query, qname, records):
+    # encode the reply into REPLY and return its length: the client's question
+    # bytes are copied as is, every owner and CNAME target is compressed, and
+    # records that would push the reply past 512 bytes are dropped with TC set
+    question_end = DNSPacket(query).section_start(ANSWER)
+    REPLY[12:question_end] = query[12:question_end]
+    names = {}
+    offset = 12
+    labels = qname.split(".")
+    for i in range(len(labels)):
+        names[".".join(labels[i:]).lower()] = offset
+        offset += 1 + query[offset]
+
+    offset = question_end
+    written = 0
+    truncated = False
+    for owner, rtype, ttl, rdata in records:
+        start = offset
+        offset = write_name(owner, offset, names)
+        fixed = offset
+        offset += 10
+        if rtype == 1:
+            REPLY[offset:offset + 4] = rdata
+            offset += 4
+        else:
+            offset = write_name(rdata, offset, names)
+        RR_FIXED.pack_into(REPLY, fixed, rtype, 1, ttl, offset - fixed - 10)
+        if offset > MAX_UDP_REPLY:
+            offset = start
+            truncated = True
+            break
+        written += 1
+
+    tid = POINTER.unpack_from(query, 0)[0]
+    flags = 0x8180 | (0x0200 if truncated else 0)
+    HEADER.pack_into(REPLY, 0, tid, flags, 1, written, 0, 0)
+    return offset
+
+
 def build_query(domain):
     tid = random.randint(0,65535)
     flags = 0x0100  # standard query
@@ -130,20 +324,38 @@ def build_query(domain):
     return header + question
 
 
+UPSTREAM = threading.local()
+
+def upstream_socket():
+    # one long-lived socket on a random port per thread for every upstream query
+    if not hasattr(UPSTREAM, "sock"):
+        UPSTREAM.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        UPSTREAM.sock.bind(("", 0))
+    return UPSTREAM.sock
+
+
 def query_dns(server_ip, domain):
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-        sock.settimeout(3)
-        query = build_query(domain)
-        try:
-            start = time.time()
-            sock.sendto(query, (server_ip, 53))
-            data, _ = sock.recvfrom(4096)
-            rtt = time.time() - start
-            return data, rtt
-        except socket.timeout:
-            return None, None
-        except Exception:
-            return None, None
+    sock = upstream_socket()
+    query = build_query(domain)
+    question = query[12:].lower()
+    try:
+        start = time.time()
+        deadline = start + 3
+        sock.sendto(query, (server_ip, 53))
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None, None
+            sock.settimeout(remaining)
+            data, addr = sock.recvfrom(4096)
+            # late replies to earlier queries share this socket: match id, server and question
+            if data[:2] == query[:2] and addr == (server_ip, 53) and data[12:12 + len(question)].lower() == question:
+                rtt = time.time() - start
+                return data, rtt
+    except socket.timeout:
+        return None, None
+    except Exception:
+        return None, None
 
 
 
@@ -151,23 +363,40 @@ def log_step(info):
     with open(LOG_FILE,"a") as f:
         f.write(str(info)+"\n")
 
-def resolve_ns_ip(ns_name):
-    # data, _ = query_dns(random.choice(ROOT_SERVERS), ns_name)
-    for root in ROOT_SERVERS:
-        data, _ = query_dns(root, ns_name)
-        if data:
-            break
+def resolve_ns_ip(ns_name, recursion_depth=0):
+    # full walk from the roots: the roots themselves never hold the NS address
+    records, ok = c_recursive_resolve(ns_name, ROOT_SERVERS[:], recursion_depth + 1)
+    if ok:
+        for _, rtype, _, rdata in records:
+            if rtype == 1:
+                return socket.inet_ntoa(rdata)
+    return None
 
-    if not data:
-        return None
-    _, _, _, answers, _, _ = ret_parse_dns_response(data)
-    for _, ip, rtype, _ in answers:
-        if rtype == 1:
+
+def chain_end(domain, records):
+    # follow the CNAME chain inside an answer section to the name that should hold the A records
+    name = domain.lower()
+    for _ in records:
+        target = next((rdata for owner, rtype, _, rdata in records if rtype == 5 and owner.lower() == name), None)
+        if target is None:
+            break
+        name = target.lower()
+    return name
+
+
+def first_ns_ip(ns_names, recursion_depth=0):
+    # look up all glueless NS names at once and go with the first address back
+    results = queue.Queue()
+    for ns in ns_names:
+        threading.Thread(target=lambda ns=ns: results.put(resolve_ns_ip(ns, recursion_depth)), daemon=True).start()
+    for _ in ns_names:
+        ip = results.get()
+        if ip:
             return ip
     return None
 
 
-def c_recursive_resolve(domain,current_servers, recursion_depth=0):
+def c_recursive_resolve(domain,current_servers, recursion_depth=0, chain=0):
 
     # if domain in CACHE:
     #     print(f"Cache hit for {domain} → {CACHE[domain]}")
@@ -177,12 +406,16 @@ def c_recursive_resolve(domain,current_servers, recursion_depth=0):
     if recursion_depth > MAX_RECURSION:
         print(f"Max recursion reached for {domain}")
         return None, False
+    if chain > MAX_CNAME_CHAIN:
+        print(f"CNAME chain too long at {domain}")
+        return None, False
 
     
 
     ret=''
     ansflag=False
-    while True:
+    # every server failing used to retry forever; give up after a few passes
+    for _ in range(MAX_PASSES):
         next_servers = []
         for server in current_servers:
             print(f"Querying {domain} at {server}")
@@ -190,11 +423,18 @@ def c_recursive_resolve(domain,current_servers, recursion_depth=0):
             if data is None:
                 print(f"Timeout from {server}")
                 continue
-            ancount, nscount, arcount,answers, authority, additional=ret_parse_dns_response(data)
+            packet = DNSPacket(data)
+            answers = packet.answer_records()
 
             if answers:
-                ip=answers[0][1]
-                ret=ip
+                target = chain_end(domain, answers)
+                if not any(rtype == 1 and owner.lower() == target for owner, rtype, _, _ in answers):
+                    # CNAME to a name outside this zone: walk again for the rest of the chain
+                    rest, ok = c_recursive_resolve(target, ROOT_SERVERS[:], 0, chain + 1)
+                    if not ok:
+                        return ret, ansflag
+                    answers = answers + rest
+                ret=answers
                 ansflag=True
                 # CACHE[domain] = ret
                 return ret,ansflag
@@ -202,17 +442,16 @@ def c_recursive_resolve(domain,current_servers, recursion_depth=0):
       
 
             if not ansflag:
+                additional = packet.additional()
+                authority = packet.authority() if not additional else []
                 if additional:
                     add_ips = [ip for _, ip, _, _ in additional]
-                    ret, ansflag = c_recursive_resolve(domain, add_ips, recursion_depth + 1)
+                    ret, ansflag = c_recursive_resolve(domain, add_ips, recursion_depth + 1, chain)
                 elif authority:
                     ns_names = [ns for _, ns, _, _ in authority]
-                    ip_list = []
-                    for ns in ns_names:
-                        ip = resolve_ns_ip(ns) 
-                        if ip: ip_list.append(ip)
-                    if ip_list:
-                        ret, ansflag = c_recursive_resolve(domain, ip_list, recursion_depth + 1)
+                    ip = first_ns_ip(ns_names, recursion_depth)
+                    if ip:
+                        ret, ansflag = c_recursive_resolve(domain, [ip], recursion_depth + 1, chain)
 
 
             if ansflag == True:
@@ -227,19 +466,13 @@ def start_dns_server():
     print("DNS resolver running on 10.0.0.5:53")
     while True:
         data, addr = s.recvfrom(512)
-        qname, _ = decode_name(data, 12)
+        qname = DNSPacket(data).name_at(12)
         print("request from", addr, "for", qname)
-        ip, ok = c_recursive_resolve(qname, ROOT_SERVERS[:])
+        records, ok = c_recursive_resolve(qname, ROOT_SERVERS[:])
         if ok:
-            tid = struct.unpack_from("!H", data, 0)[0]
-            flags = 0x8180
-            header = struct.pack(">HHHHHH", tid, flags, 1, 1, 0, 0)
-            qname_b = b''.join(len(p).to_bytes(1, 'big') + p.encode() for p in qname.split('.')) + b'\x00'
-            question = qname_b + struct.pack(">HH", 1, 1)
-            answer = b'\xc0\x0c' + struct.pack(">HHIH", 1, 1, 60, 4) + socket.inet_aton(ip)
-            packet = header + question + answer
-            s.sendto(packet, addr)
-            print("sent", ip, "to", addr)
+            size = build_response(data, qname, records)
+            s.sendto(REPLY_VIEW[:size], addr)
+            print("sent", len(records), "records to", addr)
         else:
             print("failed", qname)
 
@@ -0,0 +1,114 @@
+import argparse
+import glob
+import json
+import os
+import struct
+import time
+
+from dnslib import DNSRecord, RR, QTYPE, A
+
+from DNS_custom import DNSPacket, ret_parse_dns_response
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LOG_GLOBS = ["Resolver_no_cache_singleserver/*.json", "Resolver_Multiserver/*.json"]
+
+
+def rebuild_response(domain, step):
+    """Re-encode one logged resolution step as the wire response it summarises.
+
+    The logs keep "name :: type :: rdata" lines rather than raw packets. Referral
+    steps also get one glue A record per nameserver, as real root/TLD replies carry.
+    """
+    reply = DNSRecord.question(domain).reply()
+    glue = 0
+    for line in step["response"]:
+        parts = line.split(" :: ")
+        if len(parts) != 3:
+            continue
+        name, rtype, rdata = parts
+        try:
+            record = RR.fromZone(f"{name} 300 IN {QTYPE[int(rtype)]} {rdata}")[0]
+        except Exception:
+            continue
+        if step["stage_resolution"] in ("Root", "TLD") and record.rtype in (QTYPE.NS, QTYPE.SOA):
+            reply.add_auth(record)
+            if record.rtype == QTYPE.NS:
+                glue += 1
+                reply.add_ar(RR(str(record.rdata), QTYPE.A, rdata=A(f"192.0.2.{glue % 250 + 1}"), ttl=172800))
+        elif record.rtype == QTYPE.SOA:
+            reply.add_auth(record)
+        else:
+            reply.add_answer(record)
+    if not (reply.rr or reply.auth):
+        return None
+    return reply.pack()
+
+
+def load_responses():
+    responses = []
+    for pattern in LOG_GLOBS:
+        for file_name in sorted(glob.glob(os.path.join(REPO_DIR, pattern))):
+            with open(file_name) as f:
+                for entry in json.load(f):
+                    for step in entry["resolution_steps"]:
+                        packet = rebuild_response(entry["queried_domain"], step)
+                        if packet:
+                            responses.append(packet)
+    return responses
+
+
+def lazy_walk(data):
+    # what c_recursive_resolve reads: answers, else additional, else authority
+    packet = DNSPacket(data)
+    if packet.answers():
+        return
+    if not packet.additional():
+        packet.authority()
+
+
+def lazy_full(data):
+    packet = DNSPacket(data)
+    packet.answers()
+    packet.authority()
+    packet.additional()
+
+
+def old_parse(data):
+    # decode_name mis-reports where a name ends when labels precede a pointer
+    try:
+        ret_parse_dns_response(data)
+    except (UnicodeDecodeError, IndexError, struct.error):
+        return False
+    return True
+
+
+def run(name, parse, responses, rounds):
+    start = time.perf_counter_ns()
+    for _ in range(rounds):
+        for data in responses:
+            parse(data)
+    per_packet = (time.perf_counter_ns() - start) / (rounds * len(responses))
+    print(f"{name:>26}: {per_packet / 1000:.2f} us/packet")
+    return per_packet
+
+
+def main():
+    parser = argparse.ArgumentParser(description="wire parser benchmark on responses rebuilt from the resolver logs")
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    responses = load_responses()
+    total_bytes = sum(len(data) for data in responses)
+    print(f"{len(responses)} responses, {total_bytes / len(responses):.0f} bytes on average\n")
+
+    baseline = run("dnslib DNSRecord.parse", DNSRecord.parse, responses, args.rounds)
+    run("ret_parse_dns_response", old_parse, responses, args.rounds)
+    failures = sum(not old_parse(data) for data in responses)
+    print(f"{'':>26}  fails on {failures} of {len(responses)} responses")
+    for name, parse in (("DNSPacket (all sections)", lazy_full), ("DNSPacket (resolver walk)", lazy_walk)):
+        per_packet = run(name, parse, responses, args.rounds)
+        print(f"{'':>26}  {baseline / per_packet:.1f}x faster than dnslib")
+
+
+if __name__ == "__main__":
+    main()
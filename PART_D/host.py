@@ -1,29 +1,13 @@
-import sys
 import socket
 import time
-import csv
 import os
 import json
-
-def read_domains(file):
-    queries = []
-    with open(file, newline='') as f:
-        reader = csv.reader(f)
-        for row in reader:
-            # print(row)
-            if(row[1] == "URL"):
-                continue
-            if('.' not in row[1]):
-                continue
-            if row and row[1]:
-                try:
-                    frame_len = int(row[3]) 
-                except:
-                    frame_len = 100 
-                queries.append((row[1], frame_len))
-    
-    return queries
-
+import argparse
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from latency_histogram import LatencyHistogram
+from trace_reader import read_queries
 
 def resolve_single(domain):
     print(f"Resolving domain{domain}")
@@ -34,25 +18,47 @@ def resolve_single(domain):
         ips = list({res[4][0] for res in addr_info})
         return True, duration_ms, ips
     except socket.gaierror:
-        return False, None, []
-
-def measure_domains(domains, json_file):
-    print(len(domains))
-    total_queries = len(domains)
+        # failures (often the resolver's timeout) still count towards the latency tail
+        return False, (time.perf_counter() - start) * 1000, []
+
+def resolve_concurrently(queries, concurrency):
+    # keep `concurrency` lookups in flight and hand (query, result) pairs back in
+    # input order; only a bounded window is queued so the trace is read as we go
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        window = deque()
+        for query in queries:
+            window.append((query, pool.submit(resolve_single, query.domain)))
+            if len(window) >= concurrency * 4:
+                query, future = window.popleft()
+                yield query, future.result()
+        while window:
+            query, future = window.popleft()
+            yield query, future.result()
+
+
+def measure_domains(queries, json_file, concurrency=1):
+    total_queries = 0
     success_count = 0
     failure_count = 0
-    latencies = []
+    latency_sum = 0.0
     total_bits_sent = 0
+    histogram = LatencyHistogram()
 
     overall_start = time.perf_counter()
     results = []
-    for idx, (domain, frame_len) in enumerate(domains, 1):
-        success, latency, ips = resolve_single(domain)
+    if concurrency > 1:
+        outcomes = resolve_concurrently(queries, concurrency)
+    else:
+        outcomes = ((query, resolve_single(query.domain)) for query in queries)
+    for query, (success, latency, ips) in outcomes:
+        domain = query.domain
+        total_queries += 1
+        histogram.record(latency)
         if success:
             print(f"{domain} resolved")
             success_count += 1
-            latencies.append(latency)
-            total_bits_sent += frame_len * 8
+            latency_sum += latency
+            total_bits_sent += query.frame_len * 8
             results.append({
                 "domain": domain,
                 "status": "SUCCESS",
@@ -66,11 +72,13 @@ def measure_domains(domains, json_file):
             })
             failure_count += 1
 
-        if idx % 5 == 0 or idx == total_queries:
-            print(f"{idx}/{total_queries} queries processed...")
+        if total_queries % 5 == 0:
+            print(f"{total_queries} queries processed...")
+    if total_queries % 5:
+        print(f"{total_queries} queries processed...")
 
     total_time = time.perf_counter() - overall_start
-    avg_latency = sum(latencies) / len(latencies) if latencies else 0
+    avg_latency = latency_sum / success_count if success_count else 0
     throughput = total_bits_sent / total_time if total_time > 0 else 0
 
     summary = {
@@ -78,7 +86,8 @@ def measure_domains(domains, json_file):
         "success": success_count,
         "fail": failure_count,
         "avg_latency_ms": avg_latency,
-        "throughput_bps": throughput
+        "throughput_bps": throughput,
+        "latency_percentiles": histogram.summary()
     }
 
     if os.path.exists(json_file):
@@ -93,6 +102,7 @@ def measure_domains(domains, json_file):
     existing.append({
         "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
         "summary": summary,
+        "latency_histogram": histogram.snapshot(),
         "details": results
     })
 
@@ -104,25 +114,35 @@ def measure_domains(domains, json_file):
 
 
 def main():
-    if len(sys.argv) != 2:
-        print("Usage: python3 measure_dns.py <txt_file>")
-        sys.exit(1)
-
-    code_, csv_file = sys.argv[0], sys.argv[1]
+    parser = argparse.ArgumentParser(description="Resolve the domains of a host's PCAP trace")
+    parser.add_argument("txt_file", help="tshark export, e.g. temp_h1.txt")
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="lookups kept in flight at once (1 = one after another)")
+    parser.add_argument("--dedupe-window", type=float, default=0.0,
+                        help="skip repeats of a name within this many capture seconds (0 = keep all)")
+    parser.add_argument("--keep-noise", action="store_true",
+                        help="also resolve undotted names and wpad/isatap lookups")
+    args = parser.parse_args()
+
+    csv_file = args.txt_file
     socket.setdefaulttimeout(15.0)
 
     json_file = "Multiserverresolved_host1.json"
 
-    domain_queries = read_domains(csv_file)
-    if(domain_queries == []):
+    domain_queries = read_queries(csv_file, args.dedupe_window, args.keep_noise)
+    first = next(domain_queries, None)
+    if first is None:
         print("error in reading file")
         return 
-    stats = measure_domains(domain_queries, json_file)
+    stats = measure_domains(itertools.chain([first], domain_queries), json_file, args.concurrency)
 
     print(f"Total queries: {stats['total']}")
     print(f"Successful resolutions: {stats['success']}")
     print(f"Failed resolutions: {stats['fail']}")
     print(f"Average lookup latency: {stats['avg_latency_ms']:.2f} ms")
+    percentiles = stats['latency_percentiles']
+    print(f"Lookup latency (all lookups): p50 {percentiles['p50_ms']} ms, p90 {percentiles['p90_ms']} ms, "
+          f"p99 {percentiles['p99_ms']} ms, p99.9 {percentiles['p99.9_ms']} ms")
     print(f"Average throughput: {stats['throughput_bps']:.2f} bits/s")
 
 if __name__ == "__main__":
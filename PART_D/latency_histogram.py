@@ -0,0 +1,124 @@
+import argparse
+import json
+import math
+
+# Bucket layout: 1 us to 100 s, each bucket 4% wider than the one before
+MIN_MS = 0.001
+MAX_MS = 100000.0
+GROWTH = 1.04
+BUCKETS = int(math.ceil(math.log(MAX_MS / MIN_MS) / math.log(GROWTH))) + 1
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class LatencyHistogram:
+    """Fixed-memory latency histogram with log-spaced buckets.
+
+    Every recorded value is reported back within about 4% of its true value,
+    whatever its magnitude, and the footprint never grows (one counter per
+    bucket). Histograms merge by adding counters, so per-host, per-worker and
+    per-run snapshots combine into one distribution.
+    """
+
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def record(self, value_ms):
+        if value_ms <= MIN_MS:
+            index = 0
+        else:
+            index = min(int(math.log(value_ms / MIN_MS) / math.log(GROWTH)) + 1, BUCKETS - 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.total_ms += value_ms
+        self.max_ms = max(self.max_ms, value_ms)
+
+    def merge(self, other):
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.count += other.count
+        self.total_ms += other.total_ms
+        self.max_ms = max(self.max_ms, other.max_ms)
+        return self
+
+    def percentile(self, percent):
+        """Upper edge of the bucket holding the given percentile (capped at the max seen)."""
+        if not self.count:
+            return 0.0
+        rank = max(int(math.ceil(self.count * percent / 100)), 1)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(MIN_MS * GROWTH ** index, self.max_ms)
+        return self.max_ms
+
+    def summary(self):
+        """count, mean, p50/p90/p99/p99.9 and max, all in ms."""
+        summary = {"count": self.count, "avg_ms": round(self.total_ms / self.count, 3) if self.count else 0}
+        for percent in PERCENTILES:
+            summary[f"p{percent:g}_ms"] = round(self.percentile(percent), 3)
+        summary["max_ms"] = round(self.max_ms, 3)
+        return summary
+
+    def snapshot(self):
+        """JSON-friendly state; only non-empty buckets are kept."""
+        return {
+            "growth": GROWTH,
+            "min_ms": MIN_MS,
+            "count": self.count,
+            "total_ms": self.total_ms,
+            "max_ms": self.max_ms,
+            "buckets": {str(index): count for index, count in enumerate(self.counts) if count}
+        }
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        if snapshot.get("growth") != GROWTH or snapshot.get("min_ms") != MIN_MS:
+            raise ValueError("histogram snapshot uses a different bucket layout")
+        histogram = cls()
+        for index, count in snapshot["buckets"].items():
+            histogram.counts[int(index)] = count
+        histogram.count = snapshot["count"]
+        histogram.total_ms = snapshot["total_ms"]
+        histogram.max_ms = snapshot["max_ms"]
+        return histogram
+
+
+def find_snapshots(data, path=()):
+    """Yield (name, snapshot) for every histogram snapshot nested anywhere in a JSON document."""
+    if isinstance(data, dict):
+        if "buckets" in data and "growth" in data:
+            yield "/".join(path), data
+            return
+        for key, value in data.items():
+            yield from find_snapshots(value, path + (key,))
+    elif isinstance(data, list):
+        for value in data:
+            yield from find_snapshots(value, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge latency histogram snapshots from result JSON files")
+    parser.add_argument("json_files", nargs="+", help="host.py / replay.py results or resolver --latency-file dumps")
+    args = parser.parse_args()
+
+    merged = {}
+    for file_name in args.json_files:
+        with open(file_name) as f:
+            data = json.load(f)
+        for name, snapshot in find_snapshots(data):
+            merged.setdefault(name, LatencyHistogram()).merge(LatencyHistogram.from_snapshot(snapshot))
+
+    if not merged:
+        print("No latency histograms found")
+        return
+    for name, histogram in sorted(merged.items()):
+        summary = histogram.summary()
+        print(f"{name or 'latency'}: " + ", ".join(f"{key} {value}" for key, value in summary.items()))
+
+
+if __name__ == "__main__":
+    main()
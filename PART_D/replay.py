@@ -0,0 +1,193 @@
+import argparse
+import glob
+import heapq
+import json
+import os
+import socket
+import struct
+import threading
+import time
+
+from latency_histogram import LatencyHistogram
+from trace_reader import read_queries
+
+TEXTFILES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "textfiles")
+HEADER = struct.Struct("!HHHHHH")
+QTYPE_CLASS = struct.Struct("!HH")
+
+
+def read_trace(file, host, dedupe_window=0.0, keep_noise=False):
+    # (capture time, domain, recursion desired, host), streamed from a tshark export
+    for query in read_queries(file, dedupe_window, keep_noise):
+        yield query.captured_at, query.domain, query.recursion_desired, host
+
+
+def schedule(traces, speed, max_gap):
+    # merge the traces by capture time and turn them into send offsets from the
+    # start of the run; gaps longer than max_gap (capture pauses, clock jumps)
+    # are cut down to max_gap, then everything is compressed by speed
+    offset = 0.0
+    previous = None
+    for captured_at, domain, recursion_desired, host in heapq.merge(*traces, key=lambda query: query[0]):
+        if previous is not None:
+            offset += min(max(captured_at - previous, 0.0), max_gap) / speed
+        previous = captured_at
+        yield offset, domain, recursion_desired, host
+
+
+def build_query(domain, query_id, recursion_desired):
+    flags = 0x0100 if recursion_desired else 0
+    qname = b''.join(len(label).to_bytes(1, 'big') + label.encode() for label in domain.strip('.').split('.'))
+    return HEADER.pack(query_id, flags, 1, 0, 0, 0) + qname + b'\x00' + QTYPE_CLASS.pack(1, 1)
+
+
+class Replay:
+    # open loop: queries go out on the trace's schedule whether or not earlier
+    # ones were answered; a receiver thread matches replies by transaction ID
+
+    def __init__(self, server, port):
+        self.address = (server, port)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("", 0))
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.histogram = LatencyHistogram()
+        self.failed = 0
+        self.last_reply = None
+        self.done = False
+        self.late = 0
+        self.timeout_ms = 2000
+
+    def receive(self):
+        self.sock.settimeout(0.2)
+        while not self.done:
+            try:
+                data, _ = self.sock.recvfrom(4096)
+            except socket.timeout:
+                continue
+            except OSError:
+                continue
+            received = time.perf_counter()
+            if len(data) < 12:
+                continue
+            query_id, flags = struct.unpack_from("!HH", data, 0)
+            with self.lock:
+                sent = self.pending.pop(query_id, None)
+            if sent is None:
+                continue
+            latency = (received - sent) * 1000
+            self.histogram.record(latency)
+            if latency > self.timeout_ms:
+                self.late += 1
+            if flags & 0x000F not in (0, 3):  # anything but NOERROR / NXDOMAIN
+                self.failed += 1
+            self.last_reply = received
+
+    def run(self, queries, timeout):
+        self.timeout_ms = timeout * 1000
+        receiver = threading.Thread(target=self.receive, daemon=True)
+        receiver.start()
+        sent = 0
+        behind = []
+        last_offset = 0.0
+        start = time.perf_counter()
+        for offset, domain, recursion_desired, _ in queries:
+            delay = start + offset - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -0.001:
+                behind.append(-delay * 1000)
+            query_id = sent % 65536
+            packet = build_query(domain, query_id, recursion_desired)
+            with self.lock:
+                self.pending[query_id] = time.perf_counter()
+            try:
+                self.sock.sendto(packet, self.address)
+            except OSError:
+                pass
+            sent += 1
+            last_offset = offset
+        send_time = time.perf_counter() - start
+
+        # give the last queries their full timeout before counting them lost
+        wait_until = time.perf_counter() + timeout
+        while self.pending and time.perf_counter() < wait_until:
+            time.sleep(0.05)
+        self.done = True
+        receiver.join()
+
+        answered = self.histogram.count
+        answer_time = (self.last_reply - start) if self.last_reply else 0
+        return {
+            "sent": sent,
+            "answered": answered,
+            "lost": sent - answered,
+            "late": self.late,
+            "error_rcode": self.failed,
+            "schedule_s": last_offset,
+            "offered_qps": sent / last_offset if last_offset > 0 else 0,
+            "send_qps": sent / send_time if send_time > 0 else 0,
+            "achieved_qps": answered / answer_time if answer_time > 0 else 0,
+            "latency": self.histogram.summary(),
+            "sends_behind_schedule": len(behind),
+            "max_behind_ms": max(behind) if behind else 0
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay host DNS traces on their captured schedule (open loop)")
+    parser.add_argument("trace_files", nargs="*", help="tshark exports, e.g. ../textfiles/temp_h1.txt")
+    parser.add_argument("--all-hosts", action="store_true", help="merge all textfiles/temp_h*.txt traces")
+    parser.add_argument("--server", default="10.0.0.5")
+    parser.add_argument("--port", type=int, default=53)
+    parser.add_argument("--speed", type=float, default=1.0, help="time compression: 10 replays 10x faster")
+    parser.add_argument("--max-gap", type=float, default=60.0,
+                        help="longest pause (capture seconds) kept between two queries")
+    parser.add_argument("--timeout", type=float, default=2.0, help="seconds before a query counts as lost")
+    parser.add_argument("--dedupe-window", type=float, default=0.0,
+                        help="drop repeats of a name within this many capture seconds (0 = keep all)")
+    parser.add_argument("--keep-noise", action="store_true", help="also replay undotted names and wpad/isatap")
+    parser.add_argument("--json-file", help="append the summary to this JSON file")
+    args = parser.parse_args()
+
+    files = list(args.trace_files)
+    if args.all_hosts:
+        files += sorted(glob.glob(os.path.join(TEXTFILES, "temp_h*.txt")))
+    if not files:
+        parser.error("give trace files or --all-hosts")
+
+    traces = [read_trace(file, os.path.basename(file), args.dedupe_window, args.keep_noise) for file in files]
+    print(f"Replaying {len(files)} trace(s) at {args.speed:g}x against {args.server}:{args.port}")
+    replay = Replay(args.server, args.port)
+    summary = replay.run(schedule(traces, args.speed, args.max_gap), args.timeout)
+
+    print(f"Queries sent: {summary['sent']} over {summary['schedule_s']:.1f} s")
+    print(f"Offered load: {summary['offered_qps']:.1f} qps (sender kept up at {summary['send_qps']:.1f} qps, "
+          f"{summary['sends_behind_schedule']} sends late, worst {summary['max_behind_ms']:.1f} ms)")
+    print(f"Achieved: {summary['achieved_qps']:.1f} qps, {summary['answered']} answered, "
+          f"{summary['lost']} lost, {summary['late']} after the timeout")
+    latency = summary['latency']
+    print(f"Latency: avg {latency['avg_ms']} ms, p50 {latency['p50_ms']} ms, p90 {latency['p90_ms']} ms, "
+          f"p99 {latency['p99_ms']} ms, p99.9 {latency['p99.9_ms']} ms, max {latency['max_ms']} ms")
+
+    if args.json_file:
+        existing = []
+        if os.path.exists(args.json_file):
+            with open(args.json_file) as f:
+                try:
+                    existing = json.load(f)
+                except json.JSONDecodeError:
+                    existing = []
+        existing.append({
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "traces": files,
+            "speed": args.speed,
+            "summary": summary,
+            "latency_histogram": replay.histogram.snapshot()
+        })
+        with open(args.json_file, "w") as f:
+            json.dump(existing, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+import csv
+from collections import deque, namedtuple
+
+# One DNS query from a tshark export with the columns
+# frame.time_relative, dns.qry.name, dns.flags.recdesired, frame.len
+TraceQuery = namedtuple("TraceQuery", "captured_at domain recursion_desired frame_len")
+
+# Local service discovery that never leaves the LAN in a real network
+DISCOVERY_LABELS = {"wpad", "isatap"}
+DEFAULT_FRAME_LEN = 100
+
+
+def is_query_name(domain):
+    """True for names worth resolving: dotted, well-formed and not LAN discovery noise."""
+    name = domain.rstrip('.')
+    if not name or len(name) > 253 or name == "dns.qry.name":
+        return False
+    labels = name.split('.')
+    if len(labels) < 2 or any(not label or len(label) > 63 for label in labels):
+        return False
+    return labels[0].lower() not in DISCOVERY_LABELS
+
+
+def read_queries(file, dedupe_window=0.0, keep_noise=False):
+    """Stream the queries of a tshark export one row at a time.
+
+    Memory stays constant whatever the size of the capture. With keep_noise
+    false, header rows, undotted names and wpad/isatap lookups are dropped.
+    A dedupe_window (capture seconds) drops repeats of a name asked again
+    within that time, such as the stub resolver's retries; only the names
+    kept inside the current window are remembered.
+    """
+    recent = deque()
+    last_kept = {}
+    with open(file, newline='') as f:
+        for row in csv.reader(f):
+            if len(row) < 2 or not row[1]:
+                continue
+            try:
+                captured_at = float(row[0])
+            except ValueError:
+                continue  # header
+            domain = row[1]
+            if not keep_noise and not is_query_name(domain):
+                continue
+
+            if dedupe_window > 0:
+                while recent and captured_at - recent[0][0] > dedupe_window:
+                    expired_at, expired = recent.popleft()
+                    if last_kept.get(expired) == expired_at:
+                        del last_kept[expired]
+                key = domain.rstrip('.').lower()
+                if key in last_kept:
+                    continue
+                last_kept[key] = captured_at
+                recent.append((captured_at, key))
+
+            try:
+                frame_len = int(row[3])
+            except (IndexError, ValueError):
+                frame_len = DEFAULT_FRAME_LEN
+            recursion_desired = len(row) < 3 or row[2] != "False"
+            yield TraceQuery(captured_at, domain, recursion_desired, frame_len)
@@ -0,0 +1,89 @@
+import argparse
+import gc
+import random
+import struct
+import subprocess
+import sys
+import time
+
+from dns_cache import DNSCache
+
+
+def rss_mb():
+    """Current resident set size in MB (Linux /proc)."""
+    with open("/proc/self/statm") as f:
+        resident_pages = int(f.read().split()[1])
+    return resident_pages * 4096 / (1024 * 1024)
+
+
+# Header, question host.example.com. A IN and one A answer pointing back at the question name
+ANSWER_TEMPLATE = (struct.pack("!6H", 0, 0x8180, 1, 1, 0, 0) + b"\x04host\x07example\x03com\x00"
+                   + struct.pack("!HHHHHIH", 1, 1, 0xC00C, 1, 1, 300, 4))
+
+
+def make_response(index):
+    # Typical single-A-record answer (~50 bytes on the wire), a real one so the cache finds its TTL
+    return ANSWER_TEMPLATE + index.to_bytes(4, "big")
+
+
+def build_dict_cache(keys, ttl):
+    """The original DNS_CACHE layout: a dict of per-entry dicts."""
+    cache = {}
+    for index, key in enumerate(keys):
+        cache[key] = {"response": make_response(index), "expiry": time.time() + ttl}
+    return cache
+
+
+def lookup_dict(cache, key):
+    entry = cache.get(key)
+    if entry and entry["expiry"] > time.time():
+        return entry["response"]
+    return None
+
+
+def run(impl, entries, lookups):
+    keys = [(f"host{index}.example{index % 1000}.com.", 1) for index in range(entries)]
+    gc.collect()
+    rss_before = rss_mb()
+
+    start = time.perf_counter()
+    if impl == "dict":
+        cache = build_dict_cache(keys, 3600)
+        lookup = lambda key: lookup_dict(cache, key)
+    else:
+        cache = DNSCache(max_entries=entries, max_bytes=entries * 1024)
+        for index, key in enumerate(keys):
+            cache.put(key, make_response(index), 3600)
+        lookup = cache.get
+    insert_s = time.perf_counter() - start
+    rss_after = rss_mb()
+
+    probe = [random.choice(keys) for _ in range(lookups)]
+    start = time.perf_counter_ns()
+    for key in probe:
+        lookup(key)
+    lookup_ns = (time.perf_counter_ns() - start) / lookups
+
+    print(f"{impl:>5}: {entries} entries, insert {insert_s:.2f} s, "
+          f"lookup {lookup_ns:.0f} ns/op, RSS +{rss_after - rss_before:.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DNS cache microbenchmark")
+    parser.add_argument("--entries", type=int, default=1000000)
+    parser.add_argument("--lookups", type=int, default=1000000)
+    parser.add_argument("--impl", choices=["lru", "dict", "both"], default="both")
+    args = parser.parse_args()
+
+    if args.impl != "both":
+        run(args.impl, args.entries, args.lookups)
+        return
+
+    # Separate processes so each RSS figure starts from a clean heap
+    for impl in ("dict", "lru"):
+        subprocess.run([sys.executable, __file__, "--impl", impl,
+                        "--entries", str(args.entries), "--lookups", str(args.lookups)], check=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+from dnslib import DNSRecord
+
+import fake_hierarchy
+from latency_histogram import LatencyHistogram
+
+RESOLVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "customDNS_cache.py")
+# Resolver flags per benchmarked mode, after the three logged configurations
+MODES = {
+    "nocache": ["--no-cache", "--hedge-fanout", "1"],
+    "cache": ["--hedge-fanout", "1"],
+    "multiserver": ["--hedge-fanout", "3"]
+}
+RCODES = {0: "noerror", 2: "servfail", 3: "nxdomain"}
+
+
+class LoadClient(asyncio.DatagramProtocol):
+    """Client socket of the load generator; replies are matched on the transaction ID."""
+
+    def __init__(self):
+        self.waiting = {}
+
+    def datagram_received(self, data, address):
+        future = self.waiting.pop(data[:2], None)
+        if future is not None and not future.done():
+            future.set_result(data)
+
+
+async def run_load(address, domains, concurrency, timeout):
+    """Closed loop: concurrency clients, each sending its next query as soon as the last is answered."""
+    loop = asyncio.get_running_loop()
+    transport, client = await loop.create_datagram_endpoint(LoadClient, remote_addr=address)
+    histogram = LatencyHistogram()
+    outcomes = Counter()
+    work = iter(enumerate(domains))
+
+    async def worker():
+        for index, domain in work:
+            query = DNSRecord.question(domain)
+            query.header.id = index % 65536
+            packet = bytes(query.pack())
+            reply = loop.create_future()
+            client.waiting[packet[:2]] = reply
+            sent = time.perf_counter()
+            transport.sendto(packet)
+            try:
+                data = await asyncio.wait_for(reply, timeout)
+            except asyncio.TimeoutError:
+                client.waiting.pop(packet[:2], None)
+                outcomes["lost"] += 1
+                continue
+            histogram.record((time.perf_counter() - sent) * 1000)
+            outcomes[RCODES.get(data[3] & 0x0F, "other")] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    transport.close()
+    return histogram, outcomes, elapsed
+
+
+def wait_until_answering(address, timeout=10.0):
+    # a query for the root itself is answered by the fake root alone, without a walk
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        histogram, _, _ = asyncio.run(run_load(address, ["."], 1, 0.5))
+        if histogram.count:
+            return True
+    return False
+
+
+def stop(process, timeout=15):
+    # SIGINT lets the resolver run its finally block (latency file, summaries)
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def recording_file(prefix, mode):
+    return f"{prefix}.{mode}.jsonl"
+
+
+def bench_mode(mode, args, hints_file, work_dir, domains, counters):
+    latency_file = os.path.join(work_dir, f"{mode}_latency.json")
+    command = [sys.executable, RESOLVER, "--host", "127.0.0.1", "--port", str(args.resolver_port), "--async",
+               "--concurrency", str(args.resolver_concurrency), "--root-hints", hints_file,
+               "--upstream-port", str(args.port), "--log-file", os.path.join(work_dir, f"{mode}.jsonl"),
+               "--latency-file", latency_file] + MODES[mode]
+    if args.record_upstream:
+        recording = recording_file(args.record_upstream, mode)
+        if os.path.exists(recording):
+            os.remove(recording)
+        command += ["--record-upstream", recording]
+    elif args.replay_upstream:
+        command += ["--replay-upstream", recording_file(args.replay_upstream, mode)]
+    with open(os.path.join(work_dir, f"{mode}.out"), "w") as output:
+        process = subprocess.Popen(command, stdout=output, stderr=subprocess.STDOUT, cwd=os.path.dirname(RESOLVER),
+                                   preexec_fn=lambda: signal.signal(signal.SIGINT, signal.SIG_DFL))
+        try:
+            address = ("127.0.0.1", args.resolver_port)
+            if not wait_until_answering(address):
+                raise RuntimeError(f"resolver did not start, see {output.name}")
+            before = list(counters) if counters is not None else None
+            rounds = []
+            for _ in range(args.rounds):
+                rounds.append(asyncio.run(run_load(address, domains, args.concurrency, args.timeout)))
+            upstream = {}
+            if counters is not None:
+                upstream = {level: counters[index] - before[index]
+                            for index, level in enumerate(fake_hierarchy.LEVELS)}
+        finally:
+            stop(process)
+
+    histogram = LatencyHistogram()
+    outcomes = Counter()
+    elapsed = 0.0
+    for round_histogram, round_outcomes, round_elapsed in rounds:
+        histogram.merge(round_histogram)
+        outcomes.update(round_outcomes)
+        elapsed += round_elapsed
+    stages = {}
+    if os.path.exists(latency_file):
+        with open(latency_file) as f:
+            stages = json.load(f)["stages"]
+    queries = len(domains) * args.rounds
+    return {
+        "mode": mode,
+        "resolver_flags": MODES[mode],
+        "queries": queries,
+        "answered": histogram.count,
+        "outcomes": dict(outcomes),
+        "qps": queries / elapsed if elapsed > 0 else 0,
+        "round_qps": [len(domains) / round_elapsed for _, _, round_elapsed in rounds if round_elapsed > 0],
+        "latency": histogram.summary(),
+        "latency_histogram": histogram.snapshot(),
+        "upstream_queries": upstream,
+        "cache_hits": stages.get("cache", {}).get("count", 0),
+        "stage_histograms": stages
+    }
+
+
+def print_table(results):
+    print(f"\n{'mode':>12} {'qps':>8} {'answered':>9} {'lost':>5} {'avg ms':>8} {'p50 ms':>8} {'p90 ms':>8} "
+          f"{'p99 ms':>8} {'upstream':>9}")
+    for result in results:
+        latency = result["latency"]
+        print(f"{result['mode']:>12} {result['qps']:>8.1f} {result['answered']:>9} "
+              f"{result['outcomes'].get('lost', 0):>5} {latency['avg_ms']:>8} {latency['p50_ms']:>8} "
+              f"{latency['p90_ms']:>8} {latency['p99_ms']:>8} {sum(result['upstream_queries'].values()):>9}")
+
+
+def compare(base_file, results):
+    """Print how these results moved against the latest run stored in base_file."""
+    with open(base_file) as f:
+        base = {result["mode"]: result for result in json.load(f)[-1]["results"]}
+    print(f"\nChange against {base_file}:")
+    for result in results:
+        before = base.get(result["mode"])
+        if before is None:
+            continue
+        changes = [("qps", before["qps"], result["qps"]),
+                   ("answered", before["answered"], result["answered"]),
+                   ("cache hits", before.get("cache_hits", 0), result["cache_hits"])]
+        changes += [(key, before["latency"][key], result["latency"][key]) for key in ("p50_ms", "p90_ms", "p99_ms")]
+        print(f"{result['mode']:>12}: " + ", ".join(f"{name} {old:g} -> {new:g} ({new - old:+.4g})"
+                                                    for name, old, new in changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline resolver benchmark against a loopback DNS hierarchy")
+    parser.add_argument("--modes", nargs="+", choices=list(MODES), default=list(MODES))
+    parser.add_argument("--rounds", type=int, default=1, help="times the workload is replayed per resolver run")
+    parser.add_argument("--concurrency", type=int, default=8, help="client queries kept in flight")
+    parser.add_argument("--timeout", type=float, default=5.0, help="seconds before a client query counts as lost")
+    parser.add_argument("--delay-ms", type=float, default=20, help="delay added by every fake server")
+    parser.add_argument("--jitter-ms", type=float, default=5, help="extra uniform random delay per reply")
+    parser.add_argument("--loss", type=float, default=0.0, help="fraction of upstream queries dropped")
+    parser.add_argument("--seed", type=int, default=0, help="seed for jitter and loss")
+    parser.add_argument("--servers-per-zone", type=int, default=2)
+    parser.add_argument("--port", type=int, default=5353, help="port of the fake hierarchy")
+    parser.add_argument("--resolver-port", type=int, default=5300)
+    parser.add_argument("--resolver-concurrency", type=int, default=64)
+    parser.add_argument("--record-upstream", metavar="PREFIX",
+                        help="record each mode's upstream replies to PREFIX.<mode>.jsonl")
+    parser.add_argument("--replay-upstream", metavar="PREFIX",
+                        help="answer upstream queries from PREFIX.<mode>.jsonl recordings (no fake hierarchy)")
+    parser.add_argument("--json-file", help="append the results to this JSON file")
+    parser.add_argument("--compare", metavar="JSON_FILE", help="print the change against the last run in JSON_FILE")
+    args = parser.parse_args()
+    if args.record_upstream and args.replay_upstream:
+        parser.error("--record-upstream and --replay-upstream are mutually exclusive")
+
+    hierarchy = fake_hierarchy.Hierarchy.from_resolved(servers_per_zone=max(args.servers_per_zone, 1))
+    domains = hierarchy.workload
+    servers = sum(len(addresses) for addresses in hierarchy.zones.values())
+    print(f"{len(domains)} queries, {len(hierarchy.zones)} zones on {servers} loopback servers "
+          f"({args.delay_ms:g} ms + up to {args.jitter_ms:g} ms per hop, {args.loss:.0%} loss)")
+
+    counters = None
+    server = None
+    if args.replay_upstream:
+        print(f"Replaying recorded upstream replies from {args.replay_upstream}.<mode>.jsonl")
+    else:
+        counters = multiprocessing.Array("l", len(fake_hierarchy.LEVELS))
+        ready = multiprocessing.Event()
+        server = multiprocessing.Process(target=fake_hierarchy.run, daemon=True,
+                                         args=(hierarchy, args.port, args.delay_ms, args.jitter_ms, args.loss,
+                                               args.seed, counters, ready))
+        server.start()
+    results = []
+    try:
+        if server is not None and not ready.wait(30):
+            raise RuntimeError("fake hierarchy did not start")
+        with tempfile.TemporaryDirectory(prefix="bench_resolver_") as work_dir:
+            hints_file = os.path.join(work_dir, "root.hints")
+            fake_hierarchy.write_root_hints(hierarchy, hints_file)
+            for mode in args.modes:
+                print(f"Running {mode}: customDNS_cache.py {' '.join(MODES[mode])}")
+                results.append(bench_mode(mode, args, hints_file, work_dir, domains, counters))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.join()
+
+    print_table(results)
+    if args.compare:
+        compare(args.compare, results)
+
+    if args.json_file:
+        existing = []
+        if os.path.exists(args.json_file):
+            with open(args.json_file) as f:
+                try:
+                    existing = json.load(f)
+                except json.JSONDecodeError:
+                    existing = []
+        existing.append({
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "hierarchy": {"zones": len(hierarchy.zones), "servers": servers, "delay_ms": args.delay_ms,
+                          "jitter_ms": args.jitter_ms, "loss": args.loss, "seed": args.seed},
+            "replayed_from": args.replay_upstream,
+            "concurrency": args.concurrency,
+            "rounds": args.rounds,
+            "results": results
+        })
+        with open(args.json_file, "w") as f:
+            json.dump(existing, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
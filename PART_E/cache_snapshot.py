@@ -0,0 +1,77 @@
+import mmap
+import os
+import struct
+import time
+
+SNAPSHOT_MAGIC = b"DNSSNAP1"
+# magic, wall-clock save time, record count
+HEADER = struct.Struct("!8sdI")
+# kind, absolute expiry, original ttl, qtype, name length, data length
+RECORD = struct.Struct("!BdIHHI")
+
+KIND_ANSWER = 0
+KIND_NEGATIVE = 1
+KIND_ZONE_CUT = 2
+
+
+def _records(dns_cache, negative_cache, zone_cuts):
+    for kind, cache in ((KIND_ANSWER, dns_cache), (KIND_NEGATIVE, negative_cache), (KIND_ZONE_CUT, zone_cuts)):
+        for (name, qtype), data, expiry, ttl in cache.live_entries():
+            yield kind, name, qtype, expiry, ttl, data
+
+
+def save_snapshot(file_name, dns_cache, negative_cache, zone_cuts):
+    """Write the live cache, negative cache and zone cuts to file_name atomically."""
+    records = []
+    for kind, name, qtype, expiry, ttl, data in _records(dns_cache, negative_cache, zone_cuts):
+        name_bytes = name.encode()
+        records.append(RECORD.pack(kind, expiry, int(ttl), qtype, len(name_bytes), len(data)))
+        records.append(name_bytes)
+        records.append(data)
+
+    temp_name = file_name + ".tmp"
+    with open(temp_name, "wb") as f:
+        f.write(HEADER.pack(SNAPSHOT_MAGIC, time.time(), len(records) // 3))
+        f.write(b"".join(records))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_name, file_name)
+    return len(records) // 3
+
+
+def load_snapshot(file_name, dns_cache, negative_cache, zone_cuts):
+    """Restore a snapshot, dropping entries whose TTL ran out while we were down.
+
+    Expiry times are absolute wall-clock times, so the remaining TTL of every
+    restored entry already accounts for the time since the snapshot was saved.
+    Returns the number of entries restored.
+    """
+    try:
+        f = open(file_name, "rb")
+    except FileNotFoundError:
+        return 0
+
+    restored = 0
+    with f:
+        if os.fstat(f.fileno()).st_size < HEADER.size:
+            return 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            magic, _, count = HEADER.unpack_from(data, 0)
+            if magic != SNAPSHOT_MAGIC:
+                print(f"Ignoring {file_name}: not a cache snapshot")
+                return 0
+
+            caches = {KIND_ANSWER: dns_cache, KIND_NEGATIVE: negative_cache, KIND_ZONE_CUT: zone_cuts}
+            now = time.time()
+            offset = HEADER.size
+            for _ in range(count):
+                kind, expiry, ttl, qtype, name_len, data_len = RECORD.unpack_from(data, offset)
+                offset += RECORD.size
+                name_end = offset + name_len
+                data_end = name_end + data_len
+                if expiry > now and kind in caches:
+                    name = data[offset:name_end].decode()
+                    caches[kind].put((name, qtype), data[name_end:data_end], ttl, expiry=expiry)
+                    restored += 1
+                offset = data_end
+    return restored
@@ -1,8 +1,25 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import queue
+import signal
 import socket
+import threading
 import time
 import sys
-from dnslib import DNSRecord, RR
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from dnslib import DNSHeader, DNSQuestion, DNSRecord, RCODE, RR
 import json
+from cache_snapshot import load_snapshot, save_snapshot
+from dns_cache import DNSCache
+from latency_histogram import LatencyHistogram
+from log_writer import JsonlLogWriter, read_jsonl
+from server_select import ServerSelector
+from upstream import UpstreamPool, hedged_exchange
+from upstream_replay import RecordingPool, ReplayPool
+from wire import (CLASSIC_UDP_SIZE, UINT16, error_response, fit_response, is_truncated, parse_question,
+                  patch_response, strip_opt, tcp_response, truncate_response, with_edns)
 
 # Root DNS servers
 ROOT_DNS_SERVERS = [
@@ -11,22 +28,54 @@ ROOT_DNS_SERVERS = [
     "192.36.148.17", "192.58.128.30", "193.0.14.129", "199.7.83.42",
     "202.12.27.33"
 ]
+# UDP/TCP port of every upstream server (root hints and referrals alike)
+UPSTREAM_PORT = 53
+# False with --no-cache: every query walks from the root hints
+CACHE_ENABLED = True
 
-DNS_CACHE = {}
+# Bounded cache; limits are set from --cache-entries / --cache-mb
+DNS_CACHE = DNSCache()
+
+# RFC 2308 negative cache: (qname, qtype) for NODATA, (qname, NXDOMAIN_TYPE)
+# for a name that does not exist (and so neither does anything below it)
+NEGATIVE_CACHE = DNSCache(max_entries=50000, max_bytes=16 * 1024 * 1024)
+NXDOMAIN_TYPE = 0
+
+# Smoothed RTT per upstream server, used to pick which server to ask first
+SERVER_SELECTOR = ServerSelector()
+UPSTREAM_TIMEOUT = 2
+# Glueless nameserver lookups nested inside one walk before giving up (cyclic delegations)
+MAX_NS_DEPTH = 3
+# Upstream timeouts a glueless lookup may take in all (root, TLD, authoritative)
+NS_LOOKUP_STEPS = 3
+# Max servers one step's query is sent to (first plus hedges)
+HEDGE_FANOUT = 3
+# Long-lived upstream sockets shared by all resolutions (opened on first use)
+UPSTREAM_POOL = UpstreamPool()
+# EDNS0 UDP payload size advertised upstream and offered to EDNS clients (0 = no EDNS)
+EDNS_BUFSIZE = 1232
+EDNS_STATS = {
+    "large_responses": 0,
+    "tcp_retries": 0,
+    "tcp_failures": 0,
+    "glueless_walks_avoided": 0
+}
+EDNS_STATS_LOCK = threading.Lock()
+
+# Zone cut index: (zone, ZONE_CUT_TYPE) -> comma-separated nameserver addresses
+# learned from referrals, expiring and bounded like the caches above
+ZONE_CUTS = DNSCache(max_entries=50000, max_bytes=8 * 1024 * 1024, wire_format=False)
+ZONE_CUT_TYPE = 2  # NS
 
 
 def add_to_cache(record):
     """Add a record to cache."""
     cache_key = (str(record.rname).lower(), record.rtype)
     ttl = record.ttl if record.ttl > 0 else 300
-    expiry_time = time.time() + ttl
 
     cached_record = DNSRecord()
     cached_record.add_answer(RR(record.rname, record.rtype, rdata=record.rdata, ttl=record.ttl))
-    DNS_CACHE[cache_key] = {
-        "response": bytes(cached_record.pack()),
-        "expiry": expiry_time
-    }
+    DNS_CACHE.put(cache_key, bytes(cached_record.pack()), ttl)
 
 
 def update_cache(response):
@@ -36,32 +85,244 @@ def update_cache(response):
 
 
 def get_from_cache(domain_name, query_type):
-    """Retrieve record from cache if still valid."""
+    """Retrieve the cache entry for a name if still valid."""
     cache_key = (domain_name.lower(), query_type)
-    cached_entry = DNS_CACHE.get(cache_key)
+    entry = DNS_CACHE.get_entry(cache_key)
+    if entry is None:
+        return None
+    PREFETCHER.note_hit(cache_key, entry)
+    return entry
+
+
+def cached_reply(entry, raw_query):
+    """Stored wire response with the client's ID and TTLs aged since caching."""
+    return patch_response(entry.response, entry.ttl_offsets, raw_query[:2], entry.age(time.time()))
+
+
+def answer_from_cache(raw_query):
+    """Zero-parse cache hit: key on the raw question bytes, patch ID and TTLs in place."""
+    start = time.perf_counter()
+    question = parse_question(raw_query)
+    if question is None:
+        return None
+    domain_name, query_type, _ = question
+    entry = get_from_cache(domain_name, query_type)
+    if entry is None:
+        return None
+    response = cached_reply(entry, raw_query)
+    lookup_us = (time.perf_counter() - start) * 1e6
+    logs = [{
+        "step": 0,
+        "mode": "Cache",
+        "stage": "Cached Response",
+        "server": "Local Cache",
+        "rtt": 0,
+        "response": [f"Cached result for {domain_name} (Type {query_type})"],
+        "cache_status": "HIT",
+        "lookup_us": round(lookup_us, 1)
+    }]
+    return response, logs, round(lookup_us / 1000, 2), domain_name
+
+
+def is_negative_response(response):
+    """NXDOMAIN, or NOERROR with no answers and an SOA instead of a referral."""
+    if response.rr:
+        return False
+    if response.header.rcode == 3:
+        return True
+    return (any(record.rtype == 6 for record in response.auth)
+            and not any(record.rtype == 2 for record in response.auth))
+
+
+def add_negative_to_cache(domain_name, query_type, response, response_data):
+    """Cache a negative answer for the SOA TTL, capped by the SOA minimum."""
+    soa_records = [record for record in response.auth if record.rtype == 6]
+    if not soa_records:
+        return
+    ttl = min(min(record.ttl, record.rdata.times[4]) for record in soa_records)
+    if ttl <= 0:
+        return
+    key_type = NXDOMAIN_TYPE if response.header.rcode == 3 else query_type
+    NEGATIVE_CACHE.put((domain_name.lower(), key_type), response_data, ttl)
+
+
+def get_negative_from_cache(parsed_query):
+    """Build a negative reply to parsed_query from the negative cache, if any applies."""
+    domain_name = str(parsed_query.q.qname).lower()
+    entry = NEGATIVE_CACHE.get_entry((domain_name, parsed_query.q.qtype))
+    if entry is None:
+        labels = domain_name.rstrip(".").split(".")
+        for index in range(len(labels)):
+            entry = NEGATIVE_CACHE.get_entry((".".join(labels[index:]) + ".", NXDOMAIN_TYPE))
+            if entry is not None:
+                break
+    if entry is None:
+        return None
+
+    cached = DNSRecord.parse(entry.response)
+    age = entry.age(time.time())
+    reply = parsed_query.reply()
+    reply.header.rcode = cached.header.rcode
+    for record in cached.auth:
+        # The SOA TTL is capped by its minimum, as when the entry was cached, then aged
+        ttl = min(record.ttl, record.rdata.times[4]) if record.rtype == 6 else record.ttl
+        record.ttl = max(ttl - age, 0)
+        reply.add_auth(record)
+    return bytes(reply.pack())
+
+
+def response_status(response):
+    """SUCCESS only for replies that carry answers; negative replies count as FAILED."""
+    if response and int.from_bytes(response[6:8], "big") > 0:
+        return "SUCCESS"
+    return "FAILED"
+
+
+def remember_zone_cut(zone, server_ips, ttl):
+    """Record the nameserver addresses serving a delegated zone."""
+    ttl = ttl if ttl > 0 else 300
+    ZONE_CUTS.put((zone.lower(), ZONE_CUT_TYPE), ",".join(dict.fromkeys(server_ips)).encode(), ttl)
+
+
+def within(name, zone):
+    """Whether name is zone itself or a name below it."""
+    return zone == "." or name == zone or name.endswith("." + zone)
+
+
+def in_bailiwick(cut, zone, domain_name):
+    """Whether a server for zone may delegate cut on the way to domain_name.
 
-    if cached_entry and cached_entry["expiry"] > time.time():
-        return cached_entry["response"]
-    elif cached_entry:
-        del DNS_CACHE[cache_key]
-    return None
+    The cut must lie strictly below zone and at or above the queried name,
+    so a server can only steer walks into the part of the tree it serves.
+    """
+    cut = cut.lower()
+    return cut != zone and within(cut, zone) and within(domain_name.lower(), cut)
 
 
-def resolve_iteratively(raw_query):
-    """Perform iterative DNS resolution."""
+def update_zone_cuts(response, zone, domain_name):
+    """Index the zone cuts of a referral from a server for zone that carries glue addresses."""
+    glue = {}
+    for record in response.ar:
+        if record.rtype == 1:
+            glue.setdefault(str(record.rname).lower(), []).append((str(record.rdata), record.ttl))
+
+    cuts = {}
+    for record in response.auth:
+        if record.rtype != 2 or not in_bailiwick(str(record.rname), zone, domain_name):
+            continue
+        for server_ip, glue_ttl in glue.get(str(record.rdata).lower(), []):
+            servers, ttl = cuts.get(str(record.rname), ([], record.ttl))
+            servers.append(server_ip)
+            cuts[str(record.rname)] = (servers, min(ttl, record.ttl, glue_ttl))
+
+    for zone, (servers, ttl) in cuts.items():
+        remember_zone_cut(zone, servers, ttl)
+
+
+def find_zone_cut(domain_name):
+    """Return the deepest unexpired zone cut above domain_name and its servers."""
+    labels = domain_name.lower().rstrip(".").split(".")
+    for index in range(len(labels)):
+        zone = ".".join(labels[index:]) + "."
+        servers = ZONE_CUTS.get((zone, ZONE_CUT_TYPE))
+        if servers is not None:
+            return zone, servers.decode().split(",")
+    return ".", ROOT_DNS_SERVERS
+
+
+def load_root_hints(file_name):
+    """Read root server addresses, one per line ('#' starts a comment)."""
+    with open(file_name) as f:
+        servers = [line.split("#", 1)[0].strip() for line in f]
+    return [server for server in servers if server]
+
+
+def resolve_ns_addresses(ns_names, depth=1):
+    """Resolve glueless NS names concurrently and return the first addresses found.
+
+    The walk continues as soon as one name resolves; the other lookups keep
+    running in the background and only fill the cache. Gives up with [] once
+    NS_LOOKUP_STEPS upstream timeouts have passed without an address.
+    """
+    results = queue.Queue()
+
+    def lookup(ns_name):
+        addresses = []
+        try:
+            followup_response, _, _, _ = resolve_iteratively(bytes(DNSRecord.question(ns_name).pack()),
+                                                              depth=depth)
+            if followup_response:
+                addresses = [str(record.rdata) for record in DNSRecord.parse(followup_response).rr
+                             if record.rtype == 1]
+        except Exception as exc:
+            print(f"Lookup of nameserver {ns_name} failed: {exc}")
+        results.put(addresses)
+
+    ns_names = list(dict.fromkeys(ns_names))
+    for ns_name in ns_names:
+        threading.Thread(target=lookup, args=(ns_name,), name="ns-lookup", daemon=True).start()
+    deadline = time.monotonic() + NS_LOOKUP_STEPS * UPSTREAM_TIMEOUT
+    for _ in ns_names:
+        try:
+            addresses = results.get(timeout=max(deadline - time.monotonic(), 0))
+        except queue.Empty:
+            break
+        if addresses:
+            return addresses
+    return []
+
+
+def count_edns(stat):
+    with EDNS_STATS_LOCK:
+        EDNS_STATS[stat] += 1
+
+
+def glue_lost_at_512(response):
+    """Whether a classic 512-byte UDP reply would have kept the referral but lost all its glue."""
+    classic = truncate_response(response, CLASSIC_UDP_SIZE)
+    return not is_truncated(classic) and DNSRecord.parse(classic).ar == []
+
+
+def resolve_iteratively(raw_query, use_cache=True, depth=0):
+    """Perform iterative DNS resolution.
+
+    depth counts the glueless nameserver lookups this walk is nested in.
+    """
     parsed_query = DNSRecord.parse(raw_query)
     domain_name = str(parsed_query.q.qname)
     query_type = parsed_query.q.qtype
 
     logs = []
     start_time = time.time()
-    active_servers = ROOT_DNS_SERVERS
+    upstream_query = with_edns(raw_query, EDNS_BUFSIZE)
+    if upstream_query is None:
+        # No question (QDCOUNT 0) or a cut-short name: nothing to walk for
+        reply = DNSRecord(DNSHeader(id=parsed_query.header.id, qr=1, rd=parsed_query.header.rd,
+                                    rcode=RCODE.FORMERR))
+        logs.append({
+            "step": 0,
+            "mode": "Local",
+            "stage": "Format Error",
+            "server": "Local",
+            "rtt": 0,
+            "response": ["Query has no complete question"],
+            "cache_status": "NONE"
+        })
+        total_time = (time.time() - start_time) * 1000
+        return bytes(reply.pack()), logs, round(total_time, 2), domain_name
+
+    use_cache = use_cache and CACHE_ENABLED
+    start_zone, active_servers = find_zone_cut(domain_name) if CACHE_ENABLED else (".", ROOT_DNS_SERVERS)
+    at_root = start_zone == "."
+    # Zone the servers being asked are authoritative for
+    current_zone = start_zone
     final_response = None
     step_count = 0
     cache_status = "MISS"
 
-    cached_response = get_from_cache(domain_name, query_type)
-    if cached_response:
+    cached_entry = get_from_cache(domain_name, query_type) if use_cache else None
+    if cached_entry:
+        cached_response = cached_reply(cached_entry, raw_query)
         cache_status = "HIT"
         logs.append({
             "step": 0,
@@ -75,36 +336,76 @@ def resolve_iteratively(raw_query):
         total_time = (time.time() - start_time) * 1000
         return cached_response, logs, round(total_time, 2), domain_name
 
+    negative_response = get_negative_from_cache(parsed_query) if use_cache else None
+    if negative_response:
+        cache_status = "NEG-HIT"
+        logs.append({
+            "step": 0,
+            "mode": "Cache",
+            "stage": "Negative Response",
+            "server": "Local Cache",
+            "rtt": 0,
+            "response": [f"Cached negative result for {domain_name} (Type {query_type})"],
+            "cache_status": cache_status
+        })
+        total_time = (time.time() - start_time) * 1000
+        return negative_response, logs, round(total_time, 2), domain_name
+
     while True:
         step_count += 1
-        server_ip = active_servers[0]
-        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        udp_socket.settimeout(2)
+        exchange = hedged_exchange(upstream_query, SERVER_SELECTOR.order(active_servers), SERVER_SELECTOR,
+                                   UPSTREAM_POOL, fanout=HEDGE_FANOUT, timeout=UPSTREAM_TIMEOUT,
+                                   port=UPSTREAM_PORT)
 
-        send_time = time.time()
-        try:
-            udp_socket.sendto(raw_query, (server_ip, 53))
-            response_data, _ = udp_socket.recvfrom(2048)
-            recv_time = time.time()
-        except socket.timeout:
-            logs.append({
-                "step": step_count,
-                "mode": "Iterative",
-                "stage": "Timeout",
-                "server": server_ip,
-                "rtt": None,
-                "response": ["No response (timeout)"],
-                "cache_status": cache_status
-            })
-            udp_socket.close()
+        if exchange.response is None:
+            for server_ip in exchange.sent:
+                SERVER_SELECTOR.record_timeout(server_ip, UPSTREAM_TIMEOUT * 1000)
+                logs.append({
+                    "step": step_count,
+                    "mode": "Iterative",
+                    "stage": "Timeout",
+                    "server": server_ip,
+                    "rtt": None,
+                    "response": ["No response (timeout)"],
+                    "cache_status": cache_status,
+                    "start_zone": start_zone
+                })
+            if step_count == 1 and not at_root:
+                # Cached delegation went dead; forget it and walk from the root
+                ZONE_CUTS.pop((start_zone, ZONE_CUT_TYPE))
+                start_zone, active_servers = ".", ROOT_DNS_SERVERS
+                current_zone = start_zone
+                at_root = True
+                continue
             break
 
-        udp_socket.close()
-        rtt = (recv_time - send_time) * 1000
+        server_ip, response_data, rtt = exchange.server, exchange.response, exchange.rtt_ms
+        SERVER_SELECTOR.record_rtt(server_ip, rtt)
+        for late_server, waited_ms in exchange.waited_ms.items():
+            # No reply yet after waited_ms: a lower bound on that server's RTT
+            SERVER_SELECTOR.record_lower_bound(late_server, waited_ms)
+        for failed_server in exchange.failed:
+            SERVER_SELECTOR.record_timeout(failed_server, UPSTREAM_TIMEOUT * 1000)
+        over_tcp = is_truncated(response_data)
+        if over_tcp:
+            count_edns("tcp_retries")
+            full_response = UPSTREAM_POOL.tcp_exchange(upstream_query, server_ip, port=UPSTREAM_PORT,
+                                                       timeout=UPSTREAM_TIMEOUT)
+            if full_response:
+                response_data = full_response
+            else:
+                count_edns("tcp_failures")
+        # A reply still truncated after the TCP retry may hold a partial RRset: use it, never cache it
+        cacheable = not is_truncated(response_data)
+        response_data = strip_opt(response_data)
+        if len(response_data) > CLASSIC_UDP_SIZE:
+            count_edns("large_responses")
         parsed_response = DNSRecord.parse(response_data)
-        update_cache(parsed_response)
+        if cacheable:
+            update_cache(parsed_response)
+            update_zone_cuts(parsed_response, current_zone, domain_name)
 
-        if step_count == 1:
+        if at_root:
             stage = "Root"
         elif len(parsed_response.auth) > 0 and not parsed_response.rr:
             stage = "TLD"
@@ -126,79 +427,216 @@ def resolve_iteratively(raw_query):
             "server": server_ip,
             "rtt": round(rtt, 2),
             "response": record_summary,
-            "cache_status": cache_status
+            "cache_status": cache_status,
+            "start_zone": start_zone,
+            "upstream_packets": len(exchange.sent)
         })
+        if len(exchange.sent) > 1:
+            logs[-1]["hedged_to"] = exchange.sent
+        if over_tcp:
+            logs[-1]["tcp_retry"] = True
+        if not cacheable:
+            logs[-1]["truncated"] = True
+        at_root = False
 
         if parsed_response.rr:
             final_response = response_data
             ttl_values = [record.ttl for record in parsed_response.rr]
             ttl = min(ttl_values) if ttl_values else 300
-            DNS_CACHE[(domain_name.lower(), parsed_query.q.qtype)] = {
-                "response": final_response,
-                "expiry": time.time() + ttl
-            }
+            if cacheable:
+                DNS_CACHE.put((domain_name.lower(), parsed_query.q.qtype), final_response, ttl)
+            break
+
+        if is_negative_response(parsed_response):
+            final_response = response_data
+            if cacheable:
+                add_negative_to_cache(domain_name, query_type, parsed_response, response_data)
             break
 
         next_server_ips = []
         for record in parsed_response.ar:
             if record.rtype == 1:  # A record
                 next_server_ips.append(str(record.rdata))
+        if next_server_ips and len(response_data) > CLASSIC_UDP_SIZE and glue_lost_at_512(response_data):
+            count_edns("glueless_walks_avoided")
+
+        ns_records = [record for record in parsed_response.auth if record.rtype == 2]
+        if not ns_records:
+            break
+        referral_zone = str(ns_records[0].rname).lower()
+        if not in_bailiwick(referral_zone, current_zone, domain_name):
+            # Upward or sideways referral: the server is lame for this name
+            print(f"Ignoring referral to {referral_zone} from {server_ip} (serving {current_zone})")
+            break
 
         if not next_server_ips:
-            ns_names = [str(record.rdata) for record in parsed_response.auth if record.rtype == 2]
-            if not ns_names:
+            ns_names = [str(record.rdata) for record in ns_records]
+            if depth >= MAX_NS_DEPTH:
+                print(f"Nameserver lookups nested too deep for {domain_name}")
                 break
 
-            for ns_name in ns_names:
-                followup_query = DNSRecord.question(ns_name)
-                followup_response, _, _, _ = resolve_iteratively(bytes(followup_query.pack()))
-                if followup_response:
-                    parsed_followup = DNSRecord.parse(followup_response)
-                    for record in parsed_followup.rr:
-                        if record.rtype == 1:
-                            next_server_ips.append(str(record.rdata))
+            next_server_ips = resolve_ns_addresses(ns_names, depth + 1)
+            if next_server_ips and cacheable:
+                remember_zone_cut(referral_zone, next_server_ips, min(record.ttl for record in ns_records))
 
         if not next_server_ips:
             break
 
         active_servers = next_server_ips
+        current_zone = referral_zone
 
     total_time = (time.time() - start_time) * 1000
     return final_response, logs, round(total_time, 2), domain_name
 
 
-def write_log(file_name, log_entry):
-    """Save DNS query log to a JSON file."""
-    try:
-        with open(file_name, "r") as f:
-            existing_data = json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        existing_data = []
+class InFlightCall:
+    """One upstream walk that other identical queries can wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class InFlightQueries:
+    """Single-flight table: at most one walk per (qname, qtype) at a time."""
 
-    existing_data.append(log_entry)
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.walks_started = 0
+        self.walks_saved = 0
 
-    with open(file_name, "w") as f:
-        json.dump(existing_data, f, indent=4)
+    def resolve(self, raw_query, resolver):
+        parsed_query = DNSRecord.parse(raw_query)
+        domain_name = str(parsed_query.q.qname)
+        query_type = parsed_query.q.qtype
+        key = (domain_name.lower(), query_type)
+
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = InFlightCall()
+                self.walks_started += 1
+            else:
+                self.walks_saved += 1
+
+        if leader:
+            try:
+                call.result = resolver(raw_query)
+            except Exception as exc:
+                call.error = exc
+                raise
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call.done.set()
+            return call.result
+
+        start_time = time.time()
+        call.done.wait()
+        if call.error:
+            raise call.error
+        response, _, _, _ = call.result
+        if response:
+            # Answer carries the leader's transaction ID
+            response = raw_query[:2] + response[2:]
+        logs = [{
+            "step": 0,
+            "mode": "Coalesced",
+            "stage": "In-flight Walk",
+            "server": "Local Cache",
+            "rtt": 0,
+            "response": [f"Joined in-flight walk for {domain_name} (Type {query_type})"],
+            "cache_status": "COALESCED"
+        }]
+        total_time = (time.time() - start_time) * 1000
+        return response, logs, round(total_time, 2), domain_name
+
+    def summary(self):
+        return f"{self.walks_started} upstream walks started, {self.walks_saved} saved by coalescing"
+
+
+IN_FLIGHT = InFlightQueries()
+
+
+class StaleServer:
+    """RFC 8767 serve-stale: answer from an expired entry when a fresh walk is too slow."""
+
+    def __init__(self, client_deadline=1.8, stale_ttl=30):
+        self.enabled = False
+        self.client_deadline = client_deadline
+        self.stale_ttl = stale_ttl
+        self.executor = None
+        self.log_writer = None
+        self.served = 0
+
+    def start(self, log_writer, max_refreshes=16):
+        self.enabled = True
+        self.log_writer = log_writer
+        self.executor = ThreadPoolExecutor(max_workers=max_refreshes, thread_name_prefix="stale-refresh")
+
+    def resolve(self, raw_query):
+        parsed_query = DNSRecord.parse(raw_query)
+        domain_name = str(parsed_query.q.qname)
+        query_type = parsed_query.q.qtype
+        stale_entry = DNS_CACHE.get_stale_entry((domain_name.lower(), query_type))
+        if stale_entry is None:
+            return IN_FLIGHT.resolve(raw_query, resolve_iteratively)
+
+        start_time = time.time()
+        request_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+        walk = self.executor.submit(IN_FLIGHT.resolve, raw_query, resolve_iteratively)
+        try:
+            result = walk.result(timeout=self.client_deadline)
+            # NOERROR and NXDOMAIN are real answers; anything else falls back to stale
+            if result[0] and result[0][3] & 0x0F in (0, 3):
+                return result
+        except FutureTimeout:
+            # Keep the walk running so it refreshes the cache, and log it when done
+            walk.add_done_callback(lambda done: self._log_refresh(done, request_time))
+
+        self.served += 1
+        stale_response = patch_response(stale_entry.response, stale_entry.ttl_offsets, raw_query[:2],
+                                        ttl=self.stale_ttl)
+        logs = [{
+            "step": 0,
+            "mode": "Cache",
+            "stage": "Stale Response",
+            "server": "Local Cache",
+            "rtt": 0,
+            "response": [f"Stale result for {domain_name} (Type {query_type})"],
+            "cache_status": "STALE"
+        }]
+        total_time = (time.time() - start_time) * 1000
+        return stale_response, logs, round(total_time, 2), domain_name
 
+    def _log_refresh(self, walk, request_time):
+        if walk.exception():
+            return
+        response, query_log, elapsed_time, domain = walk.result()
+        log_entry = build_log_entry(request_time, ("stale-refresh", 0), domain, query_log, elapsed_time,
+                                    response_status(response))
+        self.log_writer.write(log_entry)
 
-log_file = "dns_resolution_log.json"
-print(f"Logging to {log_file}")
-print(f"DNS Resolver active at 10.0.0.5:53")
 
-server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-server_socket.bind(("10.0.0.5", 53))
+STALE_SERVER = StaleServer()
 
-while True:
-    raw_data, client_address = server_socket.recvfrom(512)
-    request_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
 
-    resolved_response, query_log, elapsed_time, domain = resolve_iteratively(raw_data)
-    status = "SUCCESS" if resolved_response else "FAILED"
+def resolve_query(raw_query):
+    """Resolve a client query, sharing the walk with identical in-flight queries."""
+    cached = answer_from_cache(raw_query) if CACHE_ENABLED else None
+    if cached:
+        return cached
+    if STALE_SERVER.enabled:
+        return STALE_SERVER.resolve(raw_query)
+    return IN_FLIGHT.resolve(raw_query, resolve_iteratively)
 
-    if resolved_response:
-        server_socket.sendto(resolved_response, client_address)
 
-    log_entry = {
+def build_log_entry(request_time, client_address, domain, query_log, elapsed_time, status):
+    """Build the per-query log entry written to the JSONL log."""
+    return {
         "timestamp": request_time,
         "client_ip": client_address[0],
         "queried_domain": domain,
@@ -207,5 +645,589 @@ while True:
         "status": status
     }
 
-    write_log(log_file, log_entry)
-    print(f"Resolved {domain} in {elapsed_time} ms")
\ No newline at end of file
+
+class StageLatencies:
+    """Latency histograms per resolution stage, fed from the log entries of client queries."""
+
+    STAGES = {
+        "Cached Response": "cache",
+        "Negative Response": "cache",
+        "In-flight Walk": "cache",
+        "Stale Response": "cache",
+        "Root": "root",
+        "TLD": "tld",
+        "Authoritative": "authoritative"
+    }
+
+    def __init__(self):
+        self.histograms = {stage: LatencyHistogram() for stage in ("total", "cache", "root", "tld", "authoritative")}
+
+    def record(self, log_entry):
+        self.histograms["total"].record(log_entry["total_time_ms"])
+        for step in log_entry["resolution_steps"]:
+            stage = self.STAGES.get(step.get("stage"))
+            if stage == "cache":
+                # A local answer costs the whole (sub-ms) handling time, not its rtt of 0
+                self.histograms[stage].record(log_entry["total_time_ms"])
+            elif stage and step.get("rtt") is not None:
+                self.histograms[stage].record(step["rtt"])
+
+    def summary(self):
+        lines = []
+        for stage, histogram in self.histograms.items():
+            if histogram.count:
+                stats = histogram.summary()
+                lines.append(f"  {stage:>13}: n={stats['count']} p50 {stats['p50_ms']} ms, p90 {stats['p90_ms']} ms, "
+                             f"p99 {stats['p99_ms']} ms, p99.9 {stats['p99.9_ms']} ms, max {stats['max_ms']} ms")
+        return "Latency by stage:\n" + "\n".join(lines) if lines else "Latency by stage: no queries"
+
+    def write(self, file_name):
+        with open(file_name, "w") as f:
+            json.dump({"stages": {stage: histogram.snapshot() for stage, histogram in self.histograms.items()}},
+                      f, indent=4)
+        print(f"Wrote latency histograms to {file_name}")
+
+
+STAGE_LATENCIES = StageLatencies()
+
+
+class Prefetcher:
+    """Re-resolves hot cache entries in the background before they expire."""
+
+    def __init__(self, min_hits=3, refresh_fraction=0.75, max_per_second=5, max_queued=1000):
+        self.enabled = False
+        self.min_hits = min_hits
+        self.refresh_fraction = refresh_fraction
+        self.max_per_second = max_per_second
+        self.keys = queue.Queue(maxsize=max_queued)
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.log_writer = None
+        self.refreshed = 0
+        self.dropped = 0
+
+    def start(self, log_writer):
+        self.enabled = True
+        self.log_writer = log_writer
+        threading.Thread(target=self._run, name="prefetcher", daemon=True).start()
+
+    def note_hit(self, cache_key, entry):
+        """Queue cache_key once it is hot and past refresh_fraction of its TTL."""
+        if not self.enabled or entry.hits < self.min_hits:
+            return
+        remaining = entry.expiry - time.time()
+        if remaining > entry.ttl * (1 - self.refresh_fraction):
+            return
+        with self.lock:
+            if cache_key in self.pending:
+                return
+            self.pending.add(cache_key)
+        try:
+            self.keys.put_nowait(cache_key)
+        except queue.Full:
+            with self.lock:
+                self.pending.discard(cache_key)
+            self.dropped += 1
+
+    def _run(self):
+        interval = 1.0 / self.max_per_second
+        next_slot = time.monotonic()
+        while True:
+            cache_key = self.keys.get()
+            # Rate limit: at most max_per_second upstream refreshes
+            delay = next_slot - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            next_slot = max(next_slot, time.monotonic()) + interval
+            try:
+                self._refresh(cache_key)
+            except Exception as exc:
+                print(f"Prefetch of {cache_key[0]} failed: {exc}")
+            finally:
+                with self.lock:
+                    self.pending.discard(cache_key)
+
+    def _refresh(self, cache_key):
+        domain_name, query_type = cache_key
+        request_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+        query = DNSRecord(q=DNSQuestion(domain_name, query_type))
+        response, query_log, elapsed_time, domain = resolve_iteratively(bytes(query.pack()), use_cache=False)
+        self.refreshed += 1
+        log_entry = build_log_entry(request_time, ("prefetch", 0), domain, query_log, elapsed_time,
+                                    response_status(response))
+        self.log_writer.write(log_entry)
+        print(f"Prefetched {domain} in {elapsed_time} ms")
+
+    def summary(self):
+        return f"{self.refreshed} entries prefetched, {self.dropped} prefetches dropped"
+
+
+PREFETCHER = Prefetcher()
+
+
+def serve_serial(server_socket, log_writer):
+    """Resolve one datagram at a time (original behaviour)."""
+    while True:
+        raw_data, client_address = server_socket.recvfrom(4096)
+        request_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+
+        try:
+            resolved_response, query_log, elapsed_time, domain = resolve_query(raw_data)
+        except Exception as exc:
+            print(f"Dropped query from {client_address[0]}: {exc}")
+            continue
+        status = response_status(resolved_response)
+
+        if resolved_response:
+            server_socket.sendto(fit_response(resolved_response, raw_data, EDNS_BUFSIZE), client_address)
+
+        log_entry = build_log_entry(request_time, client_address, domain, query_log, elapsed_time, status)
+        log_writer.write(log_entry)
+        STAGE_LATENCIES.record(log_entry)
+        print(f"Resolved {domain} in {elapsed_time} ms")
+
+
+class ResolverProtocol(asyncio.DatagramProtocol):
+    """Datagram server that keeps many iterative resolutions in flight."""
+
+    def __init__(self, log_writer, concurrency):
+        self.log_writer = log_writer
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, raw_data, client_address):
+        asyncio.ensure_future(self.handle_query(raw_data, client_address))
+
+    async def resolve(self, raw_data, client_address):
+        """Run resolve_query on the worker pool; None if it raised."""
+        loop = asyncio.get_running_loop()
+        async with self.semaphore:
+            try:
+                return await loop.run_in_executor(self.executor, resolve_query, raw_data)
+            except Exception as exc:
+                print(f"Dropped query from {client_address[0]}: {exc}")
+                return None
+
+    def log_query(self, request_time, client_address, result):
+        resolved_response, query_log, elapsed_time, domain = result
+        status = response_status(resolved_response)
+        log_entry = build_log_entry(request_time, client_address, domain, query_log, elapsed_time, status)
+        self.log_writer.write(log_entry)
+        STAGE_LATENCIES.record(log_entry)
+        print(f"Resolved {domain} in {elapsed_time} ms")
+
+    async def handle_query(self, raw_data, client_address):
+        request_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+        result = await self.resolve(raw_data, client_address)
+        if result is None:
+            return
+        resolved_response = result[0]
+
+        if resolved_response:
+            self.transport.sendto(fit_response(resolved_response, raw_data, EDNS_BUFSIZE), client_address)
+
+        self.log_query(request_time, client_address, result)
+
+
+class TcpFrontEnd:
+    """RFC 7766 TCP listener on the same worker pool and caches as the UDP server.
+
+    Connections stay open for any number of length-prefixed queries. Pipelined
+    queries resolve concurrently and each reply is written as soon as it is
+    ready, so answers can come back out of order (clients match them by ID).
+    A connection stops reading once max_in_flight of its queries are
+    unanswered, and is closed after idle_timeout seconds without a new query.
+    """
+
+    def __init__(self, resolver, idle_timeout=10, max_in_flight=32):
+        self.resolver = resolver
+        self.idle_timeout = idle_timeout
+        self.max_in_flight = max_in_flight
+        self.connections = 0
+        self.queries = 0
+
+    async def handle_connection(self, reader, writer):
+        client_address = writer.get_extra_info("peername")
+        self.connections += 1
+        slots = asyncio.Semaphore(self.max_in_flight)
+        write_lock = asyncio.Lock()
+        pending = set()
+        try:
+            while True:
+                try:
+                    length = await asyncio.wait_for(reader.readexactly(2), self.idle_timeout)
+                    raw_data = await asyncio.wait_for(reader.readexactly(UINT16.unpack(length)[0]),
+                                                      self.idle_timeout)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    break
+                await slots.acquire()
+                self.queries += 1
+                task = asyncio.ensure_future(self.answer(raw_data, client_address, writer, write_lock, slots))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+        finally:
+            writer.close()
+
+    async def answer(self, raw_data, client_address, writer, write_lock, slots):
+        request_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+        try:
+            result = await self.resolver.resolve(raw_data, client_address)
+            resolved_response = result[0] if result is not None else None
+            if not resolved_response:
+                # A pipelining client waits on every ID it sent, so a failure still gets a reply
+                resolved_response = error_response(raw_data, RCODE.SERVFAIL)
+
+            if resolved_response and not writer.is_closing():
+                response = tcp_response(resolved_response, raw_data, EDNS_BUFSIZE)
+                async with write_lock:
+                    writer.write(UINT16.pack(len(response)) + response)
+                    try:
+                        await writer.drain()
+                    except ConnectionError:
+                        pass
+
+            if result is not None:
+                self.resolver.log_query(request_time, client_address, result)
+        finally:
+            slots.release()
+
+    def summary(self):
+        return f"TCP: {self.connections} connections, {self.queries} queries"
+
+
+async def serve_async(host, port, log_writer, concurrency, reuse_port=False, tcp=None):
+    """Run the resolver as an asyncio datagram server, plus a TCP listener if tcp is a TcpFrontEnd."""
+    loop = asyncio.get_running_loop()
+    transport, resolver = await loop.create_datagram_endpoint(
+        lambda: ResolverProtocol(log_writer, concurrency), local_addr=(host, port),
+        reuse_port=reuse_port)
+    tcp_server = None
+    if tcp is not None:
+        tcp.resolver = resolver
+        tcp_server = await asyncio.start_server(tcp.handle_connection, host, port,
+                                                reuse_address=True, reuse_port=reuse_port)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        transport.close()
+        if tcp_server is not None:
+            tcp_server.close()
+
+
+def open_server_socket(host, port, reuse_port=False):
+    """Bind the UDP listening socket, optionally shared through SO_REUSEPORT."""
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if reuse_port:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server_socket.bind((host, port))
+    return server_socket
+
+
+def worker_log_file(log_file, worker_id):
+    """Per-worker log name, e.g. dns_resolution_log.w0.jsonl."""
+    base, ext = os.path.splitext(log_file)
+    return f"{base}.w{worker_id}{ext}"
+
+
+def write_snapshot(file_name):
+    """Save the caches and zone cuts to file_name for a warm restart."""
+    try:
+        saved = save_snapshot(file_name, DNS_CACHE, NEGATIVE_CACHE, ZONE_CUTS)
+        print(f"Saved {saved} cache entries to {file_name}")
+    except OSError as exc:
+        print(f"Could not save cache snapshot to {file_name}: {exc}")
+
+
+def snapshot_periodically(file_name, interval):
+    while True:
+        time.sleep(interval)
+        write_snapshot(file_name)
+
+
+def write_srtt_dump(file_name):
+    SERVER_SELECTOR.write_dump(file_name)
+    print(f"Wrote server RTT table to {file_name}")
+
+
+def dump_srtt_on_signal(file_name):
+    """Write the RTT table to file_name on every SIGUSR1, without stopping the server.
+
+    The handler only sets an event and a separate thread does the write: the
+    signal can arrive while the main thread holds the selector's lock.
+    """
+    requested = threading.Event()
+
+    def write_when_requested():
+        while True:
+            requested.wait()
+            requested.clear()
+            write_srtt_dump(file_name)
+
+    threading.Thread(target=write_when_requested, name="srtt-dump", daemon=True).start()
+    signal.signal(signal.SIGUSR1, lambda signum, frame: requested.set())
+
+
+def run_server(args, log_file, reuse_port=False, save_snapshots=True, srtt_dump=None, latency_file=None):
+    """Serve on one socket until interrupted, serial or async."""
+    if srtt_dump:
+        # kill -USR1 <pid> writes the current table
+        dump_srtt_on_signal(srtt_dump)
+
+    if args.snapshot:
+        load_start = time.time()
+        restored = load_snapshot(args.snapshot, DNS_CACHE, NEGATIVE_CACHE, ZONE_CUTS)
+        print(f"Restored {restored} cache entries from {args.snapshot} "
+              f"in {(time.time() - load_start) * 1000:.1f} ms")
+        if save_snapshots:
+            threading.Thread(target=snapshot_periodically, args=(args.snapshot, args.snapshot_interval),
+                             name="snapshot", daemon=True).start()
+
+    log_writer = JsonlLogWriter(log_file)
+    if args.prefetch:
+        PREFETCHER.min_hits = args.prefetch_hits
+        PREFETCHER.refresh_fraction = args.prefetch_fraction
+        PREFETCHER.max_per_second = args.prefetch_rate
+        PREFETCHER.start(log_writer)
+    if args.serve_stale:
+        STALE_SERVER.client_deadline = args.stale_deadline
+        STALE_SERVER.stale_ttl = args.stale_ttl
+        STALE_SERVER.start(log_writer)
+    tcp = TcpFrontEnd(None, args.tcp_idle_timeout, args.tcp_max_in_flight) if args.tcp else None
+    try:
+        if args.use_async:
+            asyncio.run(serve_async(args.host, args.port, log_writer, args.concurrency, reuse_port, tcp))
+        else:
+            serve_serial(open_server_socket(args.host, args.port, reuse_port), log_writer)
+    finally:
+        log_writer.close()
+        print(IN_FLIGHT.summary())
+        print(f"Cache: {DNS_CACHE.stats()}")
+        print(f"Negative cache: {NEGATIVE_CACHE.stats()}")
+        print(f"Zone cuts: {ZONE_CUTS.stats()}")
+        print(f"Upstream replies dropped (no matching query): {UPSTREAM_POOL.unmatched}")
+        print(f"EDNS: {EDNS_STATS}")
+        if tcp is not None:
+            print(tcp.summary())
+        print(STAGE_LATENCIES.summary())
+        if latency_file:
+            STAGE_LATENCIES.write(latency_file)
+        if args.prefetch:
+            print(PREFETCHER.summary())
+        if args.serve_stale:
+            print(f"{STALE_SERVER.served} stale answers served")
+        if args.snapshot and save_snapshots:
+            write_snapshot(args.snapshot)
+        if args.record_upstream or args.replay_upstream:
+            UPSTREAM_POOL.close()
+            print(UPSTREAM_POOL.summary())
+        if srtt_dump:
+            write_srtt_dump(srtt_dump)
+
+
+def run_worker(args, worker_id):
+    """Entry point of one SO_REUSEPORT worker process."""
+    log_file = worker_log_file(args.log_file, worker_id)
+    print(f"Worker {worker_id} (pid {os.getpid()}) logging to {log_file}")
+    try:
+        # Every worker warms up from the shared snapshot; only worker 0 rewrites it
+        srtt_dump = worker_log_file(args.srtt_dump, worker_id) if args.srtt_dump else None
+        latency_file = worker_log_file(args.latency_file, worker_id) if args.latency_file else None
+        run_server(args, log_file, reuse_port=True, save_snapshots=worker_id == 0, srtt_dump=srtt_dump,
+                   latency_file=latency_file)
+    except KeyboardInterrupt:
+        pass
+
+
+def merge_worker_logs(log_file, worker_count):
+    """Append the per-worker logs to log_file, tagging each entry with its worker."""
+    worker_entries = []
+    for worker_id in range(worker_count):
+        file_name = worker_log_file(log_file, worker_id)
+        if not os.path.exists(file_name):
+            continue
+        for entry in read_jsonl(file_name):
+            entry["worker"] = worker_id
+            worker_entries.append(entry)
+        os.remove(file_name)
+
+    worker_entries.sort(key=lambda entry: entry["timestamp"])
+    with open(log_file, "a") as f:
+        for entry in worker_entries:
+            f.write(json.dumps(entry) + "\n")
+    print(f"Merged {len(worker_entries)} entries from {worker_count} workers into {log_file}")
+
+
+def merge_worker_latencies(latency_file, worker_count):
+    """Combine the per-worker histogram dumps into latency_file."""
+    merged = StageLatencies()
+    for worker_id in range(worker_count):
+        file_name = worker_log_file(latency_file, worker_id)
+        if not os.path.exists(file_name):
+            continue
+        with open(file_name) as f:
+            for stage, snapshot in json.load(f)["stages"].items():
+                merged.histograms[stage].merge(LatencyHistogram.from_snapshot(snapshot))
+        os.remove(file_name)
+    print(merged.summary())
+    merged.write(latency_file)
+
+
+def serve_workers(args):
+    """Fork args.workers processes that all bind the same address with SO_REUSEPORT."""
+    workers = [multiprocessing.Process(target=run_worker, args=(args, worker_id))
+               for worker_id in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    if args.srtt_dump:
+        # kill -USR1 <launcher pid> asks every worker for its table
+        def forward_dump_request(signum, frame):
+            for worker in workers:
+                try:
+                    os.kill(worker.pid, signal.SIGUSR1)
+                except ProcessLookupError:
+                    pass
+
+        signal.signal(signal.SIGUSR1, forward_dump_request)
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        # Workers got the same SIGINT; give them time to flush their logs
+        for worker in workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+    merge_worker_logs(args.log_file, args.workers)
+    if args.latency_file:
+        merge_worker_latencies(args.latency_file, args.workers)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Iterative DNS resolver with cache")
+    parser.add_argument("--host", default="10.0.0.5", help="address to listen on")
+    parser.add_argument("--port", type=int, default=53, help="port to listen on")
+    parser.add_argument("--log-file", default="dns_resolution_log.jsonl",
+                        help="JSON Lines log file (convert with log_writer.py)")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="serve queries concurrently with asyncio")
+    parser.add_argument("--concurrency", type=int, default=64,
+                        help="max resolutions in flight in --async mode")
+    parser.add_argument("--tcp", action="store_true",
+                        help="also accept queries over TCP on the same port (implies --async)")
+    parser.add_argument("--tcp-idle-timeout", type=float, default=10,
+                        help="seconds a TCP connection may sit without a new query")
+    parser.add_argument("--tcp-max-in-flight", type=int, default=32,
+                        help="max unanswered pipelined queries per TCP connection")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes sharing the port via SO_REUSEPORT (0 = one per core)")
+    parser.add_argument("--cache-entries", type=int, default=200000,
+                        help="max cached responses before LRU eviction")
+    parser.add_argument("--cache-mb", type=int, default=64,
+                        help="memory budget of the response cache in MB")
+    parser.add_argument("--prefetch", action="store_true",
+                        help="refresh hot entries in the background before they expire")
+    parser.add_argument("--prefetch-hits", type=int, default=3,
+                        help="hits within one TTL before an entry counts as hot")
+    parser.add_argument("--prefetch-fraction", type=float, default=0.75,
+                        help="fraction of the TTL after which a hot entry is refreshed")
+    parser.add_argument("--prefetch-rate", type=float, default=5,
+                        help="max background refreshes per second")
+    parser.add_argument("--snapshot", metavar="FILE",
+                        help="load the cache from FILE at start and save it there periodically")
+    parser.add_argument("--snapshot-interval", type=float, default=60,
+                        help="seconds between cache snapshots")
+    parser.add_argument("--serve-stale", action="store_true",
+                        help="answer from expired entries when a fresh walk misses the deadline")
+    parser.add_argument("--stale-window", type=float, default=86400,
+                        help="seconds an expired entry stays available for serve-stale")
+    parser.add_argument("--stale-deadline", type=float, default=1.8,
+                        help="seconds to wait for a fresh answer before serving stale")
+    parser.add_argument("--stale-ttl", type=int, default=30,
+                        help="TTL put on stale answers")
+    parser.add_argument("--hedge-fanout", type=int, default=3,
+                        help="max servers one upstream query is sent to when replies are late")
+    parser.add_argument("--upstream-sockets", type=int, default=4,
+                        help="long-lived UDP sockets used for upstream queries")
+    parser.add_argument("--edns-bufsize", type=int, default=1232,
+                        help="EDNS0 UDP payload size advertised upstream and to clients (0 disables EDNS)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="never answer from the cache or start a walk below the root")
+    parser.add_argument("--root-hints", metavar="FILE",
+                        help="root server addresses, one per line, instead of the real root servers")
+    parser.add_argument("--upstream-port", type=int, default=53,
+                        help="port the root, TLD and authoritative servers listen on")
+    parser.add_argument("--record-upstream", metavar="FILE",
+                        help="append every upstream reply and its RTT to FILE (JSON Lines)")
+    parser.add_argument("--replay-upstream", metavar="FILE",
+                        help="answer upstream queries from a --record-upstream file instead of the network")
+    parser.add_argument("--explore-rate", type=float, default=0.05,
+                        help="chance of trying a server other than the fastest known one")
+    parser.add_argument("--latency-file", metavar="FILE",
+                        help="write per-stage latency histograms to FILE on exit (merge with latency_histogram.py)")
+    parser.add_argument("--srtt-dump", metavar="FILE",
+                        help="write the per-server RTT table to FILE on exit and on SIGUSR1 "
+                             "(with --workers, each worker writes its own FILE.wN)")
+    args = parser.parse_args()
+    if args.workers <= 0:
+        args.workers = os.cpu_count() or 1
+    if args.record_upstream and args.replay_upstream:
+        parser.error("--record-upstream and --replay-upstream are mutually exclusive")
+    if args.record_upstream and args.workers > 1:
+        parser.error("--record-upstream needs a single process (--workers 1)")
+    if args.replay_upstream and args.workers > 1:
+        parser.error("--replay-upstream needs a single process (--workers 1)")
+    if args.tcp:
+        args.use_async = True
+    return args
+
+
+def main():
+    global HEDGE_FANOUT, EDNS_BUFSIZE, UPSTREAM_PORT, CACHE_ENABLED, UPSTREAM_POOL
+    args = parse_args()
+    DNS_CACHE.set_limits(args.cache_entries, args.cache_mb * 1024 * 1024)
+    SERVER_SELECTOR.explore_rate = args.explore_rate
+    HEDGE_FANOUT = max(args.hedge_fanout, 1)
+    UPSTREAM_POOL.size = max(args.upstream_sockets, 1)
+    EDNS_BUFSIZE = args.edns_bufsize and max(args.edns_bufsize, CLASSIC_UDP_SIZE)
+    UPSTREAM_POOL.bufsize = max(EDNS_BUFSIZE, CLASSIC_UDP_SIZE)
+    if args.serve_stale:
+        DNS_CACHE.set_stale_window(args.stale_window)
+    UPSTREAM_PORT = args.upstream_port
+    CACHE_ENABLED = not args.no_cache
+    if args.root_hints:
+        ROOT_DNS_SERVERS[:] = load_root_hints(args.root_hints)
+        print(f"Root hints: {', '.join(ROOT_DNS_SERVERS)} (port {UPSTREAM_PORT})")
+    if args.record_upstream:
+        UPSTREAM_POOL = RecordingPool(args.record_upstream, UPSTREAM_POOL.size, UPSTREAM_POOL.bufsize)
+        print(f"Recording upstream exchanges to {args.record_upstream}")
+    elif args.replay_upstream:
+        UPSTREAM_POOL = ReplayPool(args.replay_upstream, ROOT_DNS_SERVERS)
+        print(f"Replaying upstream exchanges from {args.replay_upstream}")
+    if args.record_upstream or args.replay_upstream:
+        # Same exploration choices in the recorded run and every replay of it
+        SERVER_SELECTOR.random.seed(0)
+    print(f"Logging to {args.log_file}")
+    print(f"DNS Resolver active at {args.host}:{args.port}")
+    if args.use_async:
+        print(f"Async mode, up to {args.concurrency} resolutions in flight")
+    if args.tcp:
+        print(f"TCP listener on {args.host}:{args.port}, {args.tcp_max_in_flight} queries in flight "
+              f"per connection, {args.tcp_idle_timeout:g} s idle timeout")
+
+    if args.workers > 1:
+        print(f"Starting {args.workers} worker processes")
+        serve_workers(args)
+        return
+
+    run_server(args, args.log_file, srtt_dump=args.srtt_dump, latency_file=args.latency_file)
+
+
+if __name__ == "__main__":
+    main()
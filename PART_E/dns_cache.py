@@ -0,0 +1,218 @@
+import itertools
+import struct
+import threading
+import time
+
+from wire import ttl_offsets
+
+# Rough per-entry bookkeeping cost (key tuple, entry object, dict slot, wheel slot)
+ENTRY_OVERHEAD = 200
+# Share of the budget freed by each eviction, so the dict's head is rescanned rarely
+EVICT_FRACTION = 1 / 64
+# Stale wheel keys tolerated before the wheel is rebuilt, beyond one per live entry
+WHEEL_SLACK = 1024
+
+
+def entry_size(key, response):
+    """Bytes charged against the cache budget for one entry."""
+    return len(response) + len(key[0]) + ENTRY_OVERHEAD
+
+
+class CacheEntry:
+    """One cached wire response plus the offsets of its TTL fields."""
+
+    __slots__ = ("response", "expiry", "ttl", "hits", "offsets")
+
+    def __init__(self, response, expiry, ttl, offsets=None):
+        self.response = response
+        self.expiry = expiry
+        self.ttl = ttl
+        self.hits = 0
+        self.offsets = offsets
+
+    @property
+    def ttl_offsets(self):
+        """Packed TTL offsets, found on first use: most entries are never hit."""
+        if self.offsets is None:
+            try:
+                self.offsets = ttl_offsets(self.response)
+            except (IndexError, struct.error):
+                self.offsets = b""
+        return self.offsets
+
+    def age(self, now):
+        """Whole seconds since the entry was stored."""
+        return int(now - (self.expiry - self.ttl))
+
+
+class DNSCache:
+    """Bounded response cache with timing-wheel TTL expiry and LRU eviction.
+
+    Keys are filed in one-second wheel buckets by expiry time; every get and
+    put first drains the buckets that have fully elapsed, so expired entries
+    are dropped even if nobody asks for them again. Removing an entry leaves
+    its key in its bucket, where it is skipped when the bucket drains; the
+    wheel is rebuilt from the live entries once it lists twice as many keys
+    as the cache holds. With a stale_window, expired entries are kept that
+    much longer for get_stale_entry.
+
+    Recency is the insertion order of a plain dict (a hit re-inserts the
+    key), which costs half the memory of an OrderedDict. Popping the oldest
+    key of a dict one at a time rescans the deleted slots in front of it, so
+    eviction removes the least recently used EVICT_FRACTION of the budget at
+    once.
+
+    Values are DNS wire responses unless wire_format is false, in which case
+    they are opaque bytes and get no TTL offsets.
+    """
+
+    def __init__(self, max_entries=200000, max_bytes=64 * 1024 * 1024, stale_window=0, wire_format=True):
+        self.wire_format = wire_format
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.stale_window = stale_window
+        self.entries = {}
+        self.wheel = {}
+        self.wheel_keys = 0
+        self.wheel_cursor = int(time.time())
+        self.bytes_used = 0
+        self.expired = 0
+        self.evicted = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached response for key, or None if missing or expired."""
+        entry = self.get_entry(key)
+        return entry.response if entry is not None else None
+
+    def get_entry(self, key):
+        """Return the live entry for key and count the hit, or None."""
+        now = time.time()
+        with self.lock:
+            if now >= self.wheel_cursor + 1:
+                self._expire(now)
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry.expiry <= now:
+                if entry.expiry + self.stale_window <= now:
+                    self._remove(key)
+                    self.expired += 1
+                return None
+            self.entries[key] = self.entries.pop(key)
+            entry.hits += 1
+            return entry
+
+    def get_stale_entry(self, key):
+        """Return an expired entry still inside the stale window, or None."""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry.expiry > now or entry.expiry + self.stale_window <= now:
+                return None
+            return entry
+
+    def put(self, key, response, ttl, expiry=None):
+        """Cache response under key for ttl seconds, evicting to stay within budget.
+
+        expiry overrides now + ttl, e.g. for entries restored from a snapshot.
+        """
+        now = time.time()
+        if expiry is None:
+            expiry = now + ttl
+        entry = CacheEntry(response, expiry, ttl, None if self.wire_format else b"")
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = entry
+            self.bytes_used += entry_size(key, response)
+            self.wheel.setdefault(int(expiry + self.stale_window), []).append(key)
+            self.wheel_keys += 1
+            if now >= self.wheel_cursor + 1:
+                self._expire(now)
+            self._evict()
+            if self.wheel_keys > 2 * len(self.entries) + WHEEL_SLACK:
+                self._rebuild_wheel()
+
+    def set_stale_window(self, stale_window):
+        """Set how long expired entries are kept."""
+        with self.lock:
+            self.stale_window = stale_window
+            self._rebuild_wheel()
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            self._remove(key)
+            return entry.response
+
+    def set_limits(self, max_entries, max_bytes):
+        with self.lock:
+            self.max_entries = max_entries
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def live_entries(self):
+        """List (key, response, expiry, ttl) for every unexpired entry, oldest use first."""
+        now = time.time()
+        with self.lock:
+            return [(key, entry.response, entry.expiry, entry.ttl)
+                    for key, entry in self.entries.items() if entry.expiry > now]
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "bytes": self.bytes_used,
+            "expired": self.expired,
+            "evicted": self.evicted
+        }
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self.bytes_used -= entry_size(key, entry.response)
+
+    def _rebuild_wheel(self):
+        """File every live key once, dropping the keys of removed and overwritten entries."""
+        self.wheel = {}
+        for key, entry in self.entries.items():
+            self.wheel.setdefault(int(entry.expiry + self.stale_window), []).append(key)
+        self.wheel_keys = len(self.entries)
+
+    def _expire(self, now):
+        """Drop the entries filed in every wheel bucket that has fully elapsed."""
+        current = int(now)
+        if current - self.wheel_cursor > len(self.wheel):
+            # Long idle gap: visit only the buckets that exist
+            due = sorted(second for second in self.wheel if second < current)
+        else:
+            due = range(self.wheel_cursor, current)
+        for second in due:
+            keys = self.wheel.pop(second, ())
+            self.wheel_keys -= len(keys)
+            for key in keys:
+                entry = self.entries.get(key)
+                # Keys of removed or overwritten entries may still sit in their old bucket
+                if entry is not None and int(entry.expiry + self.stale_window) == second:
+                    self._remove(key)
+                    self.expired += 1
+        self.wheel_cursor = max(self.wheel_cursor, current)
+
+    def _evict(self):
+        """Once over the entry or byte budget, evict least recently used entries to EVICT_FRACTION below it."""
+        if len(self.entries) <= self.max_entries and self.bytes_used <= self.max_bytes:
+            return
+        max_entries = self.max_entries - int(self.max_entries * EVICT_FRACTION)
+        max_bytes = self.max_bytes - int(self.max_bytes * EVICT_FRACTION)
+        while self.entries and (len(self.entries) > max_entries or self.bytes_used > max_bytes):
+            # One scan of the dict's head per batch rather than per key
+            batch = max(len(self.entries) - max_entries, 64)
+            for key in list(itertools.islice(self.entries, batch)):
+                self._remove(key)
+                self.evicted += 1
+                if len(self.entries) <= max_entries and self.bytes_used <= max_bytes:
+                    break
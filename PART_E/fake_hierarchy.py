@@ -0,0 +1,235 @@
+import argparse
+import asyncio
+import glob
+import hashlib
+import json
+import os
+import random
+import resource
+import signal
+
+from dnslib import A, DNSRecord, NS, QTYPE, RCODE, RR, SOA
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESOLVED_GLOB = os.path.join(REPO_DIR, "Resolved_domain_names", "*.json")
+# Second-level labels under which registrations sit one level deeper (example.co.uk)
+SECOND_LEVEL = {"ac", "co", "com", "edu", "gob", "gov", "ne", "net", "or", "org"}
+# Query counters shared with the benchmark, one per level of the hierarchy
+LEVELS = ("root", "tld", "authoritative")
+
+
+def zone_of(domain):
+    """Registered zone a name belongs to: example.com. for www.example.com."""
+    labels = domain.rstrip(".").lower().split(".")
+    size = 3 if len(labels) > 2 and labels[-2] in SECOND_LEVEL and len(labels[-1]) == 2 else 2
+    return ".".join(labels[-size:]) + "."
+
+
+def loopback_address(index):
+    # Linux routes all of 127.0.0.0/8 to lo, so every server gets its own address
+    return f"127.53.{index // 250}.{index % 250 + 1}"
+
+
+def level_of(zone):
+    if zone == ".":
+        return 0
+    return 1 if zone.count(".") == 1 else 2
+
+
+class Hierarchy:
+    """Root, TLD and authoritative zones for a fixed set of names, all on loopback.
+
+    Names that resolved in the recorded runs get their recorded IPv4
+    addresses (or a stable made-up one); names that failed exist only as
+    NXDOMAIN inside their zone, so every run sees the same answers.
+    """
+
+    def __init__(self, servers_per_zone=2, ttl=300, negative_ttl=60):
+        self.servers_per_zone = servers_per_zone
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.zones = {}
+        self.names = {}
+        self.workload = []
+        self.add_zone(".")
+
+    def add_zone(self, zone):
+        if zone not in self.zones:
+            first = len(self.zones) * self.servers_per_zone
+            self.zones[zone] = [loopback_address(first + index) for index in range(self.servers_per_zone)]
+
+    def add_domain(self, domain, addresses=None):
+        name = domain.rstrip(".").lower() + "."
+        self.workload.append(name)
+        zone = zone_of(name)
+        self.add_zone(name.split(".")[-2] + ".")
+        self.add_zone(zone)
+        if addresses is None or name in self.names:
+            return
+        addresses = [address for address in addresses if address.count(".") == 3]
+        if not addresses:
+            digest = hashlib.sha1(name.encode()).digest()
+            addresses = [f"198.18.{digest[0]}.{digest[1]}"]
+        self.names[name] = addresses
+
+    @classmethod
+    def from_resolved(cls, pattern=RESOLVED_GLOB, **options):
+        """Build the hierarchy from the host.py runs in Resolved_domain_names/."""
+        hierarchy = cls(**options)
+        for file_name in sorted(glob.glob(pattern)):
+            with open(file_name) as f:
+                runs = json.load(f)
+            for run in runs:
+                for detail in run["details"]:
+                    domain = detail["domain"]
+                    if "." not in domain or domain == "dns.qry.name":
+                        continue
+                    resolved = detail["status"] == "SUCCESS"
+                    hierarchy.add_domain(domain, detail["resolved_ips"] if resolved else None)
+        return hierarchy
+
+    def ns_names(self, zone):
+        # in-zone nameserver names, always reached through glue
+        suffix = zone if zone != "." else "root-servers.invalid."
+        return [f"ns{index + 1}.{suffix}" for index in range(len(self.zones[zone]))]
+
+    def delegation(self, zone, qname):
+        """Child zone of zone on the way to qname, or None when zone is authoritative."""
+        if qname == zone:
+            return None
+        labels = qname.rstrip(".").split(".")
+        depth = 0 if zone == "." else zone.count(".")
+        for size in range(depth + 1, len(labels) + 1):
+            candidate = ".".join(labels[-size:]) + "."
+            if candidate in self.zones:
+                return candidate
+        return None
+
+    def add_ns(self, reply, zone, section):
+        for ns_name, address in zip(self.ns_names(zone), self.zones[zone]):
+            section(RR(zone, QTYPE.NS, rdata=NS(ns_name), ttl=172800))
+            reply.add_ar(RR(ns_name, QTYPE.A, rdata=A(address), ttl=172800))
+
+    def answer(self, zone, request):
+        """Response of a server for zone: referral, answer, NODATA or NXDOMAIN."""
+        qname = str(request.q.qname).lower()
+        reply = request.reply()
+        child = self.delegation(zone, qname)
+        if child:
+            reply.header.aa = 0
+            self.add_ns(reply, child, reply.add_auth)
+            return reply
+        if qname == zone and request.q.qtype == QTYPE.NS:
+            self.add_ns(reply, zone, reply.add_answer)
+            return reply
+        addresses = self.names.get(qname)
+        if addresses and request.q.qtype in (QTYPE.A, QTYPE.ANY):
+            for address in addresses:
+                reply.add_answer(RR(qname, QTYPE.A, rdata=A(address), ttl=self.ttl))
+            return reply
+        if addresses is None:
+            reply.header.rcode = RCODE.NXDOMAIN
+        primary = self.ns_names(zone)[0]
+        soa = SOA(primary, "hostmaster." + primary.split(".", 1)[1], (1, 3600, 600, 86400, self.negative_ttl))
+        reply.add_auth(RR(zone, QTYPE.SOA, rdata=soa, ttl=self.negative_ttl))
+        return reply
+
+    def root_hints(self):
+        return list(self.zones["."])
+
+
+class ZoneServer(asyncio.DatagramProtocol):
+    """One loopback nameserver: answers for its zone after a delay, or drops the query."""
+
+    def __init__(self, hierarchy, zone, delay_ms, jitter_ms, loss, rng, counters):
+        self.hierarchy = hierarchy
+        self.zone = zone
+        self.delay_ms = delay_ms
+        self.jitter_ms = jitter_ms
+        self.loss = loss
+        self.rng = rng
+        self.counters = counters
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        if self.counters is not None:
+            self.counters[level_of(self.zone)] += 1
+        if self.loss and self.rng.random() < self.loss:
+            return
+        try:
+            response = self.hierarchy.answer(self.zone, DNSRecord.parse(data)).pack()
+        except Exception:
+            return
+        delay = (self.delay_ms + self.rng.uniform(0, self.jitter_ms)) / 1000
+        asyncio.get_running_loop().call_later(delay, self.transport.sendto, response, address)
+
+
+async def serve(hierarchy, port, delay_ms=0.0, jitter_ms=0.0, loss=0.0, seed=0, counters=None, ready=None):
+    """Start one UDP server per zone server address and run until cancelled."""
+    loop = asyncio.get_running_loop()
+    rng = random.Random(seed)
+    transports = []
+    try:
+        for zone, addresses in hierarchy.zones.items():
+            for address in addresses:
+                transport, _ = await loop.create_datagram_endpoint(
+                    lambda zone=zone: ZoneServer(hierarchy, zone, delay_ms, jitter_ms, loss, rng, counters),
+                    local_addr=(address, port))
+                transports.append(transport)
+        if ready is not None:
+            ready.set()
+        await asyncio.Event().wait()
+    finally:
+        for transport in transports:
+            transport.close()
+
+
+def raise_fd_limit(needed):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < needed:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(needed, hard), hard))
+
+
+def run(hierarchy, port, delay_ms, jitter_ms, loss, seed, counters=None, ready=None):
+    """Process entry point used by bench_resolver.py (stops on SIGTERM)."""
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    raise_fd_limit(sum(len(addresses) for addresses in hierarchy.zones.values()) + 64)
+    try:
+        asyncio.run(serve(hierarchy, port, delay_ms, jitter_ms, loss, seed, counters, ready))
+    except KeyboardInterrupt:
+        pass
+
+
+def write_root_hints(hierarchy, file_name):
+    with open(file_name, "w") as f:
+        f.write("# loopback root servers written by fake_hierarchy.py\n")
+        for address in hierarchy.root_hints():
+            f.write(address + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stand-in root/TLD/authoritative servers on loopback")
+    parser.add_argument("--port", type=int, default=5353, help="port every fake server listens on")
+    parser.add_argument("--servers-per-zone", type=int, default=2)
+    parser.add_argument("--delay-ms", type=float, default=20, help="added to every reply")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="extra uniform random delay per reply")
+    parser.add_argument("--loss", type=float, default=0, help="fraction of queries dropped")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--hints-file", default="root.hints", help="where to write the root server addresses")
+    args = parser.parse_args()
+
+    hierarchy = Hierarchy.from_resolved(servers_per_zone=max(args.servers_per_zone, 1))
+    write_root_hints(hierarchy, args.hints_file)
+    servers = sum(len(addresses) for addresses in hierarchy.zones.values())
+    print(f"{len(hierarchy.zones)} zones on {servers} loopback servers, port {args.port}; "
+          f"root hints in {args.hints_file}")
+    print(f"Point the resolver at it: python customDNS_cache.py --host 127.0.0.1 --port 5300 "
+          f"--root-hints {args.hints_file} --upstream-port {args.port}")
+    run(hierarchy, args.port, args.delay_ms, args.jitter_ms, args.loss, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+
+class JsonlLogWriter:
+    """Append-only JSON Lines log sink flushed by a background thread."""
+
+    _CLOSE = object()
+
+    def __init__(self, file_name, batch_size=256, flush_interval=0.5, fsync_interval=2.0):
+        self.file_name = file_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.entries = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self.thread.start()
+
+    def write(self, log_entry):
+        """Queue one log entry; never blocks on disk I/O."""
+        self.entries.put(log_entry)
+
+    def close(self):
+        """Flush everything queued so far and stop the writer thread."""
+        self.entries.put(self._CLOSE)
+        self.thread.join()
+
+    def _next_batch(self):
+        """Collect up to batch_size entries, waiting at most flush_interval."""
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                entry = self.entries.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(entry)
+            if entry is self._CLOSE:
+                break
+        return batch
+
+    def _run(self):
+        last_fsync = time.monotonic()
+        with open(self.file_name, "a") as f:
+            while True:
+                batch = self._next_batch()
+                closing = bool(batch) and batch[-1] is self._CLOSE
+                if closing:
+                    batch.pop()
+                if batch:
+                    f.write("".join(json.dumps(entry) + "\n" for entry in batch))
+                    f.flush()
+                if closing or time.monotonic() - last_fsync >= self.fsync_interval:
+                    os.fsync(f.fileno())
+                    last_fsync = time.monotonic()
+                if closing:
+                    return
+
+
+def read_jsonl(file_name):
+    """Yield the entries of a JSON Lines log, skipping a torn last line."""
+    with open(file_name, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+
+def jsonl_to_json(jsonl_file, json_file):
+    """Convert a JSON Lines log into the indented JSON array used by the analysis files."""
+    count = 0
+    with open(json_file, "w") as out:
+        out.write("[")
+        for entry in read_jsonl(jsonl_file):
+            out.write(",\n" if count else "\n")
+            body = json.dumps(entry, indent=4)
+            out.write("\n".join("    " + line for line in body.splitlines()))
+            count += 1
+        out.write("\n]" if count else "]")
+    return count
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python3 log_writer.py <log.jsonl> <log.json>")
+        sys.exit(1)
+    converted = jsonl_to_json(sys.argv[1], sys.argv[2])
+    print(f"Wrote {converted} entries to {sys.argv[2]}")
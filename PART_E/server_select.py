@@ -0,0 +1,110 @@
+import json
+import random
+import threading
+
+# RTT assumed for servers we have never measured (same default as Unbound)
+UNKNOWN_RTT_MS = 376
+MAX_RTT_MS = 120000
+# Retransmission timeout bounds; an unmeasured server gets RFC 6298's initial 1 s
+INITIAL_RTO_MS = 1000
+MIN_RTO_MS = 50
+
+
+class ServerStats:
+    """Smoothed RTT state of one nameserver."""
+
+    __slots__ = ("srtt", "rttvar", "samples", "timeouts", "selected")
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.samples = 0
+        self.timeouts = 0
+        self.selected = 0
+
+
+class ServerSelector:
+    """Orders candidate nameservers by smoothed RTT, exploring others now and then.
+
+    SRTT and RTTVAR follow RFC 6298 (alpha 1/8, beta 1/4). A timeout doubles
+    the server's SRTT so a dead server sinks to the back of the order.
+    """
+
+    def __init__(self, explore_rate=0.05, seed=None):
+        self.explore_rate = explore_rate
+        self.table = {}
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+
+    def record_rtt(self, server, rtt_ms):
+        with self.lock:
+            stats = self.table.setdefault(server, ServerStats())
+            if stats.srtt is None:
+                stats.srtt = rtt_ms
+                stats.rttvar = rtt_ms / 2
+            else:
+                stats.rttvar = 0.75 * stats.rttvar + 0.25 * abs(stats.srtt - rtt_ms)
+                stats.srtt = 0.875 * stats.srtt + 0.125 * rtt_ms
+            stats.samples += 1
+
+    def record_timeout(self, server, timeout_ms):
+        with self.lock:
+            stats = self.table.setdefault(server, ServerStats())
+            if stats.srtt is None:
+                stats.srtt = timeout_ms
+                stats.rttvar = timeout_ms / 2
+            else:
+                stats.srtt = min(max(stats.srtt, timeout_ms) * 2, MAX_RTT_MS)
+            stats.timeouts += 1
+
+    def record_lower_bound(self, server, rtt_ms):
+        """Server has not answered after rtt_ms: raise its SRTT to at least that, never lower it.
+
+        Unmeasured servers are left alone: a lower bound is not a sample.
+        """
+        with self.lock:
+            stats = self.table.get(server)
+            if stats is not None and stats.srtt is not None:
+                stats.srtt = min(max(stats.srtt, rtt_ms), MAX_RTT_MS)
+
+    def estimate(self, server):
+        stats = self.table.get(server)
+        if stats is None or stats.srtt is None:
+            return UNKNOWN_RTT_MS
+        return stats.srtt
+
+    def timeout_for(self, server, max_ms):
+        """Adaptive timeout for server: SRTT + 4 * RTTVAR, clamped to [MIN_RTO_MS, max_ms]."""
+        with self.lock:
+            stats = self.table.get(server)
+            if stats is None or stats.srtt is None:
+                rto = INITIAL_RTO_MS
+            else:
+                rto = stats.srtt + 4 * stats.rttvar
+        return min(max(rto, MIN_RTO_MS), max_ms)
+
+    def order(self, servers):
+        """Return servers fastest first; with probability explore_rate a random one leads."""
+        with self.lock:
+            ordered = sorted(dict.fromkeys(servers), key=self.estimate)
+            if len(ordered) > 1 and self.random.random() < self.explore_rate:
+                ordered.insert(0, ordered.pop(self.random.randrange(1, len(ordered))))
+            if ordered:
+                self.table.setdefault(ordered[0], ServerStats()).selected += 1
+        return ordered
+
+    def dump(self):
+        """The RTT table as a dict, fastest server first."""
+        with self.lock:
+            rows = sorted(self.table.items(), key=lambda item: self.estimate(item[0]))
+            return {server: {
+                "srtt_ms": round(stats.srtt, 2) if stats.srtt is not None else None,
+                "rttvar_ms": round(stats.rttvar, 2) if stats.rttvar is not None else None,
+                "samples": stats.samples,
+                "timeouts": stats.timeouts,
+                "selected": stats.selected
+            } for server, stats in rows}
+
+    def write_dump(self, file_name):
+        with open(file_name, "w") as f:
+            json.dump(self.dump(), f, indent=4)
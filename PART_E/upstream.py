@@ -0,0 +1,185 @@
+import queue
+import random
+import selectors
+import socket
+import threading
+import time
+from collections import namedtuple
+
+from wire import UINT16, question_bytes
+
+# server/response/rtt_ms of the winning reply (None if nobody answered),
+# every server the query went to, how long each loser was waited on, and
+# the servers the query could not even be sent to or that answered with an error
+ExchangeResult = namedtuple("ExchangeResult", ["server", "response", "rtt_ms", "sent", "waited_ms", "failed"])
+# FORMERR, SERVFAIL, NOTIMP, REFUSED: the server cannot help with this query
+ERROR_RCODES = {1, 2, 4, 5}
+
+
+class UpstreamPool:
+    """A few long-lived UDP sockets shared by every upstream query.
+
+    Each socket is bound to a kernel-chosen (randomized) ephemeral port. Every
+    outgoing query gets a fresh random transaction ID, and one receiver thread
+    hands each reply to the waiter registered under (ID, server address,
+    question), restoring the caller's original ID. Stray or spoofed replies
+    that match no waiter are dropped.
+    """
+
+    def __init__(self, size=4, bufsize=2048):
+        self.size = size
+        self.bufsize = bufsize
+        self.sockets = []
+        self.waiters = {}
+        self.lock = threading.Lock()
+        self.random = random.SystemRandom()
+        self.unmatched = 0
+
+    def _start(self):
+        poller = selectors.DefaultSelector()
+        for _ in range(self.size):
+            udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            udp_socket.bind(("", 0))
+            poller.register(udp_socket, selectors.EVENT_READ)
+            self.sockets.append(udp_socket)
+        threading.Thread(target=self._receive, args=(poller,), name="upstream-pool", daemon=True).start()
+
+    def send(self, query, address, deliver):
+        """Send query to address; deliver(response) runs on the receiver thread.
+
+        Returns a key for cancel(). Raises OSError if the datagram cannot be sent.
+        """
+        question = question_bytes(query)
+        with self.lock:
+            if not self.sockets:
+                self._start()
+            while True:
+                transaction_id = self.random.getrandbits(16).to_bytes(2, "big")
+                key = (transaction_id, address, question)
+                if key not in self.waiters:
+                    break
+            self.waiters[key] = (query[:2], deliver)
+        try:
+            self.random.choice(self.sockets).sendto(transaction_id + query[2:], address)
+        except OSError:
+            self.cancel(key)
+            raise
+        return key
+
+    def cancel(self, key):
+        with self.lock:
+            self.waiters.pop(key, None)
+
+    def pending(self):
+        return len(self.waiters)
+
+    def tcp_exchange(self, query, server, port=53, timeout=2.0):
+        """TCP retry of a truncated reply, routed through the pool so recording/replay pools see it too."""
+        return tcp_exchange(query, server, port, timeout)
+
+    def _receive(self, poller):
+        while True:
+            for selector_key, _ in poller.select():
+                try:
+                    response, address = selector_key.fileobj.recvfrom(self.bufsize)
+                except OSError:
+                    continue
+                if len(response) < 12:
+                    continue
+                key = (response[:2], address, question_bytes(response))
+                with self.lock:
+                    waiter = self.waiters.pop(key, None)
+                if waiter is None:
+                    self.unmatched += 1
+                    continue
+                original_id, deliver = waiter
+                deliver(original_id + response[2:])
+
+
+def hedged_exchange(query, servers, selector, pool, fanout=3, timeout=2.0, port=53):
+    """Send query to servers in order, hedging to the next one when a reply is late.
+
+    The first server gets the query immediately. Whenever the adaptive timeout
+    of the most recently queried server passes without a reply (or the send
+    itself fails), the query also goes to the next server, up to fanout
+    servers. The first valid reply from any of them wins. A reply whose
+    RCODE is in ERROR_RCODES counts as a failure of that server: the query
+    goes to the next candidate straight away and the other hedges keep
+    running. The first such reply is returned only if nothing better
+    arrives. The exchange gives up timeout seconds after the last send.
+    """
+    candidates = list(servers[:fanout])
+    replies = queue.Queue()
+    in_flight = {}
+    sent = []
+    failed = []
+    error_reply = None
+    next_hedge = deadline = time.monotonic()
+
+    try:
+        while True:
+            now = time.monotonic()
+            if candidates and (now >= next_hedge or not in_flight):
+                server = candidates.pop(0)
+                try:
+                    key = pool.send(query, (server, port),
+                                    lambda response, server=server: replies.put((server, response, time.monotonic())))
+                except OSError:
+                    failed.append(server)
+                    continue
+                in_flight[server] = (key, now)
+                sent.append(server)
+                next_hedge = now + selector.timeout_for(server, timeout * 1000) / 1000
+                deadline = now + timeout
+                continue
+
+            if now >= deadline or not in_flight:
+                break
+
+            wake_at = min(deadline, next_hedge) if candidates else deadline
+            try:
+                server, response, recv_time = replies.get(timeout=max(wake_at - now, 0))
+            except queue.Empty:
+                continue
+            _, sent_at = in_flight.pop(server)
+            if response[3] & 0x0F in ERROR_RCODES:
+                failed.append(server)
+                if error_reply is None:
+                    error_reply = (server, response, (recv_time - sent_at) * 1000)
+                next_hedge = recv_time
+                continue
+            waited = {other: (recv_time - other_sent) * 1000 for other, (_, other_sent) in in_flight.items()}
+            return ExchangeResult(server, response, (recv_time - sent_at) * 1000, sent, waited, failed)
+    finally:
+        for key, _ in in_flight.values():
+            pool.cancel(key)
+
+    if error_reply is not None:
+        server, response, rtt_ms = error_reply
+        return ExchangeResult(server, response, rtt_ms, sent, {}, [other for other in failed if other != server])
+    return ExchangeResult(None, None, None, sent, {}, failed)
+
+
+def _recv_exact(conn, size):
+    chunks = []
+    while size:
+        chunk = conn.recv(size)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def tcp_exchange(query, server, port=53, timeout=2.0):
+    """Send query over TCP (2-byte length prefix, RFC 1035 section 4.2.2); return the reply or None."""
+    try:
+        with socket.create_connection((server, port), timeout=timeout) as conn:
+            conn.sendall(UINT16.pack(len(query)) + query)
+            length = _recv_exact(conn, 2)
+            response = _recv_exact(conn, UINT16.unpack(length)[0]) if length else None
+    except OSError:
+        return None
+    if not response or response[:2] != query[:2] or question_bytes(response) != question_bytes(query):
+        return None
+    return response
@@ -0,0 +1,235 @@
+import base64
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+
+from dnslib import DNSRecord, QTYPE
+
+from log_writer import JsonlLogWriter, read_jsonl
+from upstream import UpstreamPool
+from wire import question_bytes
+
+
+def recording_entry(transport, server, query, response, rtt_ms):
+    # response None: no reply within rtt_ms, when the resolver stopped waiting
+    return {
+        "transport": transport,
+        "server": server,
+        "question": base64.b64encode(question_bytes(query)).decode(),
+        "rtt_ms": round(rtt_ms, 3),
+        "response": base64.b64encode(response).decode() if response is not None else None
+    }
+
+
+class RecordingPool(UpstreamPool):
+    """UpstreamPool that also appends every upstream exchange and its RTT to a JSON Lines recording.
+
+    A query that is cancelled before its reply arrives (a timeout, or a hedge
+    that lost the race) is recorded as silence after the time waited, which
+    is all the resolver learned about that server.
+    """
+
+    def __init__(self, file_name, size=4, bufsize=2048):
+        super().__init__(size, bufsize)
+        self.file_name = file_name
+        self.writer = JsonlLogWriter(file_name)
+        self.recorded = 0
+
+    def send(self, query, address, deliver):
+        sent = time.perf_counter()
+
+        def record(response):
+            rtt_ms = (time.perf_counter() - sent) * 1000
+            self.writer.write(recording_entry("udp", address[0], query, response, rtt_ms))
+            self.recorded += 1
+            if response is not None:
+                deliver(response)
+
+        return super().send(query, address, record)
+
+    def cancel(self, key):
+        with self.lock:
+            waiter = self.waiters.pop(key, None)
+        if waiter is not None:
+            _, record = waiter
+            record(None)
+
+    def tcp_exchange(self, query, server, port=53, timeout=2.0):
+        sent = time.perf_counter()
+        response = super().tcp_exchange(query, server, port, timeout)
+        self.writer.write(recording_entry("tcp", server, query, response, (time.perf_counter() - sent) * 1000))
+        self.recorded += 1
+        return response
+
+    def close(self):
+        self.writer.close()
+
+    def summary(self):
+        return f"Upstream recording: {self.recorded} exchanges written to {self.file_name}"
+
+
+def load_recording(file_name):
+    """(transport, server, question bytes) -> [(rtt_ms, response or None), ...] in recorded order."""
+    recording = {}
+    for entry in read_jsonl(file_name):
+        key = (entry["transport"], entry["server"], base64.b64decode(entry["question"]))
+        response = base64.b64decode(entry["response"]) if entry["response"] else None
+        recording.setdefault(key, deque()).append((entry["rtt_ms"], response))
+    return recording
+
+
+def index_recording(recording, root_servers=()):
+    """Learn zone structure from the recorded replies.
+
+    Returns server -> the other nameservers of its zone (from referral glue and
+    the root hints), and server -> [(zone cut, rtt_ms, referral)] for every
+    referral that server gave.
+    """
+    groups = [set(root_servers)]
+    referrals = {}
+    for (_, server, _), replies in recording.items():
+        for rtt_ms, response in replies:
+            if response is None:
+                continue
+            try:
+                parsed = DNSRecord.parse(response)
+            except Exception:
+                continue
+            glue = {str(record.rdata) for record in parsed.ar if record.rtype == QTYPE.A}
+            if len(glue) > 1:
+                groups.append(glue)
+            cuts = [str(record.rname).lower() for record in parsed.auth if record.rtype == QTYPE.NS]
+            if cuts and not parsed.rr:
+                referrals.setdefault(server, []).append((cuts[0], rtt_ms, response))
+    siblings = {}
+    for group in groups:
+        for server in group:
+            siblings.setdefault(server, set()).update(group - {server})
+    return siblings, referrals
+
+
+def below(name, zone):
+    return zone == "." or name == zone or name.endswith("." + zone)
+
+
+class ReplayPool:
+    """Drop-in for UpstreamPool that answers from a recording instead of the network.
+
+    A query to a server gets the next exchange recorded for (server, question):
+    the reply after the RTT measured when it was recorded, or silence where
+    the recorded run got none. The last exchange of a key is repeated once the
+    others are used up.
+
+    Concurrency and RTT ordering make a replay ask slightly different
+    servers than the recorded run did. A server never asked the question gets
+    the reply a sibling nameserver of the same zone gave to it; failing that,
+    a referral that server (or a sibling) gave for another name below the same
+    zone cut, with the question rewritten. Anything else gets no reply.
+    """
+
+    def __init__(self, file_name, root_servers=()):
+        self.file_name = file_name
+        self.recording = load_recording(file_name)
+        self.siblings, self.referrals = index_recording(self.recording, root_servers)
+        self.size = 0
+        self.bufsize = 0
+        self.unmatched = 0
+        self.replayed = 0
+        self.substituted = 0
+        self.rewritten = 0
+        self.misses = 0
+        self.waiting = set()
+        self.schedule = []
+        self.keys = itertools.count()
+        self.wakeup = threading.Condition()
+        # started on the first send, like UpstreamPool's receiver
+        self.running = False
+
+    def _next_exchange(self, transport, server, query):
+        question = question_bytes(query)
+        with self.wakeup:
+            replies = self.recording.get((transport, server, question))
+            if replies:
+                self.replayed += 1
+                return replies.popleft() if len(replies) > 1 else replies[0]
+            # a sibling's lost packet says nothing about this server, so prefer any reply it got
+            recorded = [exchange for sibling in sorted(self.siblings.get(server, ()))
+                        for exchange in self.recording.get((transport, sibling, question), ())]
+            if recorded:
+                self.substituted += 1
+                return next((exchange for exchange in recorded if exchange[1] is not None), recorded[0])
+            referral = self._referral(server, query)
+            if referral is not None:
+                self.rewritten += 1
+                return referral
+            self.misses += 1
+            return None, None
+
+    def _referral(self, server, query):
+        """Deepest recorded referral from server or its siblings that covers the queried name."""
+        request = DNSRecord.parse(query)
+        qname = str(request.q.qname).lower()
+        best = None
+        for candidate in [server] + sorted(self.siblings.get(server, ())):
+            for cut, rtt_ms, response in self.referrals.get(candidate, ()):
+                if below(qname, cut) and (best is None or len(cut) > len(best[0])):
+                    best = (cut, rtt_ms, response)
+        if best is None:
+            return None
+        referral = DNSRecord.parse(best[2])
+        referral.questions = [request.q]
+        return best[1], bytes(referral.pack())
+
+    def send(self, query, address, deliver):
+        key = next(self.keys)
+        rtt_ms, response = self._next_exchange("udp", address[0], query)
+        if response is not None:
+            with self.wakeup:
+                if not self.running:
+                    self.running = True
+                    threading.Thread(target=self._run, name="upstream-replay", daemon=True).start()
+                self.waiting.add(key)
+                heapq.heappush(self.schedule, (time.monotonic() + rtt_ms / 1000, key, deliver,
+                                               query[:2] + response[2:]))
+                self.wakeup.notify()
+        return key
+
+    def cancel(self, key):
+        with self.wakeup:
+            self.waiting.discard(key)
+
+    def pending(self):
+        return len(self.waiting)
+
+    def tcp_exchange(self, query, server, port=53, timeout=2.0):
+        rtt_ms, response = self._next_exchange("tcp", server, query)
+        if response is None:
+            if rtt_ms is not None:
+                time.sleep(min(rtt_ms / 1000, timeout))
+            return None
+        if rtt_ms > timeout * 1000:
+            time.sleep(timeout)
+            return None
+        time.sleep(rtt_ms / 1000)
+        return query[:2] + response[2:]
+
+    def _run(self):
+        while True:
+            with self.wakeup:
+                while not self.schedule or self.schedule[0][0] > time.monotonic():
+                    self.wakeup.wait(self.schedule[0][0] - time.monotonic() if self.schedule else None)
+                _, key, deliver, response = heapq.heappop(self.schedule)
+                if key not in self.waiting:
+                    continue
+                self.waiting.discard(key)
+            deliver(response)
+
+    def close(self):
+        pass
+
+    def summary(self):
+        return (f"Upstream replay from {self.file_name}: {self.replayed} exchanges replayed, "
+                f"{self.substituted} answered from a sibling server, {self.rewritten} from a referral "
+                f"for another name, {self.misses} never recorded")
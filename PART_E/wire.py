@@ -0,0 +1,256 @@
+import struct
+
+HEADER = struct.Struct("!HHHHHH")
+UINT16 = struct.Struct("!H")
+UINT32 = struct.Struct("!I")
+
+# Bytes dnslib prints unescaped in a label; anything else takes the slow path
+LABEL_BYTES = bytes(range(0x21, 0x7F)).replace(b".", b"").replace(b"\\", b"")
+
+OPT_TYPE = 41
+# root owner name, type, UDP payload size, extended rcode/version/flags, rdlength
+OPT_RR = struct.Struct("!BHHIH")
+TC_FLAG = 0x0200
+CLASSIC_UDP_SIZE = 512
+
+
+def parse_question(data):
+    """Read (qname, qtype, qclass) of the first question straight from the wire.
+
+    qname is formatted like str(dnslib.DNSLabel), e.g. "www.example.com.".
+    Returns None for anything unusual (no question, compression or escapes
+    in the name, truncated packet) so the caller can fall back to dnslib.
+    """
+    if len(data) < 17 or UINT16.unpack_from(data, 4)[0] == 0:
+        return None
+    labels = []
+    offset = 12
+    try:
+        while True:
+            length = data[offset]
+            if length == 0:
+                offset += 1
+                break
+            if length > 63:
+                return None
+            label = data[offset + 1:offset + 1 + length]
+            if len(label) != length or label.translate(None, LABEL_BYTES):
+                return None
+            labels.append(label)
+            offset += 1 + length
+        qtype, qclass = struct.unpack_from("!HH", data, offset)
+    except (IndexError, struct.error):
+        return None
+    qname = b".".join(labels).decode("ascii") + "."
+    return qname, qtype, qclass
+
+
+def _skip_name(data, offset):
+    while True:
+        length = data[offset]
+        if length == 0:
+            return offset + 1
+        if length & 0xC0 == 0xC0:
+            return offset + 2
+        offset += 1 + length
+
+
+def question_bytes(data):
+    """The first question (name, type, class) as lowercased wire bytes, or None."""
+    try:
+        if UINT16.unpack_from(data, 4)[0] == 0:
+            return None
+        end = _skip_name(data, 12) + 4
+    except (IndexError, struct.error):
+        return None
+    if end > len(data):
+        return None
+    return bytes(data[12:end]).lower()
+
+
+def ttl_offsets(response):
+    """Offsets of every RR TTL field in a wire response (OPT pseudo-records excluded).
+
+    Packed as consecutive UINT16 values, which takes far less memory per
+    cache entry than a tuple of ints.
+    """
+    _, _, qdcount, ancount, nscount, arcount = HEADER.unpack_from(response, 0)
+    offset = 12
+    for _ in range(qdcount):
+        offset = _skip_name(response, offset) + 4
+    offsets = []
+    for _ in range(ancount + nscount + arcount):
+        offset = _skip_name(response, offset)
+        rtype = UINT16.unpack_from(response, offset)[0]
+        if rtype != OPT_TYPE:
+            offsets.append(offset + 4)
+        offset += 10 + UINT16.unpack_from(response, offset + 8)[0]
+    return struct.pack(f"!{len(offsets)}H", *offsets)
+
+
+def patch_response(response, offsets, query_id, elapsed=0, ttl=None):
+    """Copy response with the client's transaction ID and adjusted TTLs.
+
+    TTLs are decremented by elapsed seconds (never below zero), or all set
+    to ttl when it is given.
+    """
+    buffer = bytearray(response)
+    buffer[0:2] = query_id
+    for (offset,) in UINT16.iter_unpack(offsets):
+        if ttl is None:
+            remaining = UINT32.unpack_from(buffer, offset)[0] - elapsed
+            UINT32.pack_into(buffer, offset, remaining if remaining > 0 else 0)
+        else:
+            UINT32.pack_into(buffer, offset, ttl)
+    return bytes(buffer)
+
+
+def _records(response):
+    """(start, end, section, rtype) of every RR after the question; section 0/1/2 = answer/authority/additional."""
+    _, _, qdcount, ancount, nscount, arcount = HEADER.unpack_from(response, 0)
+    offset = 12
+    for _ in range(qdcount):
+        offset = _skip_name(response, offset) + 4
+    records = []
+    for section, count in enumerate((ancount, nscount, arcount)):
+        for _ in range(count):
+            start = offset
+            offset = _skip_name(response, offset)
+            rtype = UINT16.unpack_from(response, offset)[0]
+            offset += 10 + UINT16.unpack_from(response, offset + 8)[0]
+            records.append((start, offset, section, rtype))
+    return records
+
+
+def _rebuild(response, records, truncated=False):
+    """Header and question of response followed by only the given records."""
+    question_end = _question_end(response)
+    counts = [0, 0, 0]
+    for _, _, section, _ in records:
+        counts[section] += 1
+    query_id, flags = struct.unpack_from("!HH", response, 0)
+    if truncated:
+        flags |= TC_FLAG
+    qdcount = UINT16.unpack_from(response, 4)[0]
+    return b"".join([HEADER.pack(query_id, flags, qdcount, *counts), bytes(response[12:question_end])]
+                    + [bytes(response[start:end]) for start, end, _, _ in records])
+
+
+def _question_end(response):
+    offset = 12
+    for _ in range(UINT16.unpack_from(response, 4)[0]):
+        offset = _skip_name(response, offset) + 4
+    return offset
+
+
+def with_edns(query, bufsize):
+    """The first question of query with an OPT record advertising bufsize (no OPT if bufsize is 0).
+
+    None when query has no complete question to ask.
+    """
+    try:
+        if UINT16.unpack_from(query, 4)[0] == 0:
+            return None
+        end = _skip_name(query, 12) + 4
+    except (IndexError, struct.error):
+        return None
+    if end > len(query):
+        return None
+    query_id, flags = struct.unpack_from("!HH", query, 0)
+    if not bufsize:
+        return HEADER.pack(query_id, flags, 1, 0, 0, 0) + bytes(query[12:end])
+    return (HEADER.pack(query_id, flags, 1, 0, 0, 1) + bytes(query[12:end])
+            + OPT_RR.pack(0, OPT_TYPE, bufsize, 0, 0))
+
+
+def error_response(query, rcode):
+    """Reply to query carrying only rcode, its ID, opcode, RD and first question.
+
+    None if query is too short to hold a header. A question that cannot be
+    read is left out.
+    """
+    if len(query) < HEADER.size:
+        return None
+    query_id, flags = struct.unpack_from("!HH", query, 0)
+    # keep opcode and RD, set QR and RA
+    flags = (flags & 0x7900) | 0x8080 | rcode
+    question = b""
+    try:
+        if UINT16.unpack_from(query, 4)[0]:
+            end = _skip_name(query, 12) + 4
+            if end <= len(query):
+                question = bytes(query[12:end])
+    except IndexError:
+        pass
+    return HEADER.pack(query_id, flags, 1 if question else 0, 0, 0, 0) + question
+
+
+def strip_opt(response):
+    """response without its OPT pseudo-records (the upstream's EDNS parameters are not ours to pass on)."""
+    if UINT16.unpack_from(response, 10)[0] == 0:
+        return response
+    records = _records(response)
+    kept = [record for record in records if record[3] != OPT_TYPE]
+    if len(kept) == len(records):
+        return response
+    return _rebuild(response, kept)
+
+
+def is_truncated(response):
+    return bool(UINT16.unpack_from(response, 2)[0] & TC_FLAG)
+
+
+def client_udp_size(query):
+    """The UDP payload size the client's OPT record advertises, or None if it sent no OPT."""
+    if UINT16.unpack_from(query, 10)[0] == 0:
+        return None
+    try:
+        for start, _, section, rtype in _records(query):
+            if section == 2 and rtype == OPT_TYPE:
+                return max(UINT16.unpack_from(query, _skip_name(query, start) + 2)[0], CLASSIC_UDP_SIZE)
+    except (IndexError, struct.error):
+        pass
+    return None
+
+
+def truncate_response(response, limit):
+    """Cut an OPT-free response to at most limit bytes on record boundaries.
+
+    Additional records are dropped first; TC is set only when answer or
+    authority records had to go too (RFC 2181 section 9).
+    """
+    if len(response) <= limit:
+        return response
+    records = _records(response)
+    size = _question_end(response)
+    kept = []
+    for record in records:
+        size += record[1] - record[0]
+        if size > limit:
+            break
+        kept.append(record)
+    truncated = any(section < 2 for _, _, section, _ in records[len(kept):])
+    return _rebuild(response, kept, truncated)
+
+
+def fit_response(response, query, max_udp_size):
+    """Shape an OPT-free response for a UDP client: size-limit it and add an OPT if the client used EDNS."""
+    client_size = client_udp_size(query) if max_udp_size else None
+    if client_size is None:
+        return truncate_response(response, CLASSIC_UDP_SIZE)
+    limit = min(client_size, max_udp_size)
+    return _add_opt(truncate_response(response, limit - OPT_RR.size), max_udp_size)
+
+
+def tcp_response(response, query, max_udp_size):
+    """Shape an OPT-free response for a TCP client: never truncated, OPT added if the client used EDNS."""
+    if max_udp_size and client_udp_size(query) is not None:
+        return _add_opt(response, max_udp_size)
+    return response
+
+
+def _add_opt(response, bufsize):
+    buffer = bytearray(response)
+    UINT16.pack_into(buffer, 10, UINT16.unpack_from(buffer, 10)[0] + 1)
+    buffer += OPT_RR.pack(0, OPT_TYPE, bufsize, 0, 0)
+    return bytes(buffer)